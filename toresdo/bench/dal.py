@@ -0,0 +1,97 @@
+'''
+Benchmark cases of DAL hot paths, on sqlite ':memory:'.
+
+Each case is (name, sizes, setup), 'setup(size)' prepares data
+and returns the function to be timed.
+'''
+
+
+from toresdo.dal import field
+from toresdo.dal import Cond
+from toresdo.dal.sql.sqlite import Model
+
+
+class Item(Model):
+
+    @field()
+    def name(self):
+        return ""
+
+    @field()
+    def age(self):
+        return 0
+
+    @field()
+    def score(self):
+        return 0
+
+
+def _fill(n):
+    Item.save_rows((("i{0}".format(i), i, i % 7) for i in range(n)), trusted=True)
+
+
+def field_get(size):
+    o = Item(name="Tom", age=1)
+    return lambda: o.age
+
+
+def field_set(size):
+    o = Item(name="Tom", age=1)
+    def fn():
+        o.age = 2
+    return fn
+
+
+def cond_to_cmd(size):
+    """
+    compile an 'or' group with 'size' conditions, statement-cache hit.
+    """
+    c = Cond.group(Cond.or__, *[Item.age == i for i in range(size)]) if size > 1 else Item.age == 1
+    return lambda: Cond.to_cmd(Item, c)
+
+
+def pool_req_dispose(size):
+    Item._prepare()
+    pool = Item.__conn_pool__
+    def fn():
+        pool.dispose(pool.req())
+    return fn
+
+
+def session_iter(size):
+    _fill(size)
+    return lambda: sum(1 for _ in Item.find(batch_size=1000))
+
+
+def find_one(size):
+    _fill(size)
+    return lambda: Item.find_one(Item.age == size // 2)
+
+
+def save(size):
+    Item._prepare()
+    def fn():
+        Item(name="Tom", age=1).save()
+    return fn
+
+
+def save_many(size):
+    Item._prepare()
+    objs = [Item(name="i{0}".format(i), age=i) for i in range(size)]
+    return lambda: Item.save_many(objs)
+
+
+CASES = [
+    ("field_get", [1], field_get),
+    ("field_set", [1], field_set),
+    ("cond_to_cmd", [1, 10, 100], cond_to_cmd),
+    ("pool_req_dispose", [1], pool_req_dispose),
+    ("session_iter", [100, 1000, 10000], session_iter),
+    ("find_one", [100, 1000, 10000], find_one),
+    ("save", [1], save),
+    ("save_many", [100, 1000, 10000], save_many),
+]
+
+
+def teardown():
+    Model.release()
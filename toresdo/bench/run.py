@@ -0,0 +1,111 @@
+'''
+Run benchmarks of DAL, and compare with a stored baseline.
+
+    python -m toresdo.bench.run --out result.json
+    python -m toresdo.bench.run --baseline baseline.json --margin 0.25
+
+Results are seconds per call, the best of several rounds, keyed
+by "<case>[<size>]". With a baseline, exit with 1 when any case
+is slower than baseline * (1 + margin).
+'''
+
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import platform
+import importlib
+
+BENCH_MODULES = [
+    'toresdo.bench.dal',
+]
+
+
+def measure(fn, rounds=5, min_time=0.05):
+    """
+    seconds per call of 'fn', the best of 'rounds'. Each round
+    calls it enough times to last at least 'min_time' seconds.
+    """
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        spent = time.perf_counter() - t
+        if spent >= min_time:
+            break
+        number *= 2 if spent <= 0 else max(2, min(10, int(min_time / spent) + 1))
+
+    best = spent / number
+    for _ in range(rounds - 1):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t) / number)
+    return best
+
+
+def run(modules=BENCH_MODULES, only=None, rounds=5, min_time=0.05):
+    results = {}
+    for name in modules:
+        mod = importlib.import_module(name)
+        for case, sizes, setup in mod.CASES:
+            if only and case not in only:
+                continue
+            for size in sizes:
+                try:
+                    results["{0}[{1}]".format(case, size)] = measure(setup(size), rounds, min_time)
+                finally:
+                    mod.teardown()
+
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "results": results,
+    }
+
+
+def compare(res, baseline, margin):
+    """
+    return a list of (key, baseline, current) slower than baseline
+    by more than 'margin'. Cases not in both are skipped.
+    """
+    slower = []
+    for k, v in sorted(res["results"].items()):
+        base = baseline["results"].get(k)
+        if base != None and v > base * (1 + margin):
+            slower.append((k, base, v))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmarks of toresdo.dal")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of results to compare with")
+    parser.add_argument("--margin", type=float, default=0.2, help="allowed slowdown, 0.2 for 20%%")
+    parser.add_argument("--case", action="append", help="only run this case, could be repeated")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    res = run(only=args.case, rounds=args.rounds)
+    for k, v in res["results"].items():
+        print("{0:<24}{1:>14.3f} us".format(k, v * 1e6))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(res, json.load(f), args.margin)
+        for k, base, v in slower:
+            print("REGRESSION {0}: {1:.3f} us -> {2:.3f} us".format(k, base * 1e6, v * 1e6))
+        if len(slower) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+'''
+Benchmark of PRAGMA profiles of the sqlite adapter.
+
+    python -m toresdo.bench.sqlite_profile [n_rows]
+
+Each profile writes 'n_rows' rows in small transactions and
+large chunks, then reads them back by point lookups and a full
+scan, against a database file in a temporary directory.
+'''
+
+
+import os
+import sys
+import time
+import tempfile
+from toresdo.dal import field
+from toresdo.dal.sql.sqlite import Model
+
+
+PROFILES = [None, "durable", "throughput"]
+
+
+def _new_model(path, profile):
+    conn = {"path": path}
+    if profile != None:
+        conn["profile"] = profile
+
+    class Bench(Model):
+        __toresdo_db_conn__ = conn
+        __toresdo_index__ = [("key",)]
+
+        @field()
+        def key(self):
+            return 0
+
+        @field()
+        def value(self):
+            return ""
+
+    return Bench
+
+
+def _timed(fn):
+    t = time.perf_counter()
+    fn()
+    return time.perf_counter() - t
+
+
+def run_profile(profile, n_rows, d):
+    """
+    return seconds spent in each step
+    """
+    Bench = _new_model(os.path.join(d, "{0}.db".format(profile)), profile)
+    n_small = max(n_rows // 10, 1)
+    try:
+        res = {}
+        # one transaction per row
+        res["insert_each"] = _timed(lambda: [Bench(key=i, value="v").save() for i in range(n_small)])
+        res["insert_chunk"] = _timed(lambda: Bench.save_rows(((n_small + i, "v") for i in range(n_rows)), chunk_size=1000))
+        res["point_read"] = _timed(lambda: [Bench.find_one(Bench.key == i) for i in range(0, n_rows, 10)])
+        res["scan"] = _timed(lambda: sum(1 for _ in Bench.find(batch_size=1000)))
+        return res
+    finally:
+        Model.release()
+
+
+def main(n_rows=20000):
+    with tempfile.TemporaryDirectory() as d:
+        results = {str(p): run_profile(p, n_rows, d) for p in PROFILES}
+
+    steps = list(results[str(PROFILES[0])].keys())
+    print("{0:<12}".format("profile") + "".join("{0:>14}".format(s) for s in steps))
+    for p, res in results.items():
+        print("{0:<12}".format(p) + "".join("{0:>13.4f}s".format(res[s]) for s in steps))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(v) for v in sys.argv[1:2]])
@@ -5,9 +5,14 @@ Created on Aug 5, 2013
 '''
 
 from __future__ import absolute_import
+import asyncio
 import collections
+import concurrent.futures
+import contextvars
 import abc
 import inspect
+import threading
+import time
 
 
 class Cond(object):
@@ -15,7 +20,7 @@ class Cond(object):
     represent a condition used in querying database, like where-clause
     used in SQL.
     """
-    
+
     """
     condition operator for value
     """
@@ -32,7 +37,17 @@ class Cond(object):
     gt = _comp_base_ + 5
     # greater than or equal
     ge = _comp_base_ + 6
-    
+
+    """
+    condition operator for a tuple of values
+    """
+    # in a list of values
+    in_ = _comp_base_ + 7
+    # not in a list of values
+    not_in = _comp_base_ + 8
+    # between (low, high), inclusive
+    between = _comp_base_ + 9
+
     """
     conditional operator for pair
     """
@@ -42,6 +57,32 @@ class Cond(object):
     # or
     or__ = _bool_base_ + 2
 
+    """
+    sort order, used in 'order_by' option
+    """
+    asc = 1
+    desc = -1
+
+    """
+    query options whose values are bound like condition
+    values, others are part of the shape of a statement.
+    """
+    _opt_values = ("limit", "offset")
+
+    """
+    query options of (name, value) pairs, ex. "set" of update,
+    names are part of the shape, and values are bound.
+    """
+    _opt_pairs = ("set",)
+
+    """
+    values of in_/not_in with length up to this are bound one
+    by one, and adapters could inline them. Longer ones are bound
+    as one tuple, adapters should pass them as a whole, ex. as
+    a JSON array, to avoid the limit of variables in a statement.
+    """
+    _max_inline = 32
+
     def __init__(self, op, *args):
         self._op = op
         self._operand = args
@@ -79,14 +120,271 @@ class Cond(object):
     i_op = 3    # op of current group
     i_idx = 4   # index of current condition/group in parent group
 
+    class _Slot(object):
+        """
+        placeholder of a value in a compiled statement,
+        it would be replaced by the idx-th value of the
+        condition-tree when binding.
+        """
+        __slots__ = ("_idx",)
+
+        def __init__(self, idx):
+            self._idx = idx
+
+        def __repr__(self):
+            return "<Slot {0}>".format(self._idx)
+
+    @staticmethod
+    def _inline(op, v):
+        """
+        check if values of a multi-valued condition are bound one by one
+        """
+        return op == Cond.between or len(v) <= Cond._max_inline
+
     @staticmethod
-    def to_cmd(model, cond):
+    def _shape(cond, opt):
+        """
+        get the structural fingerprint of a condition-tree and
+        query options, and values of all conditions in traversal
+        order, followed by values of options in Cond._opt_values.
+
+        Two trees with the same fingerprint would be compiled
+        into the same statement, only values are different.
+        """
+        key = []
+        values = []
+        to_handle = [cond] if cond != None else []
+        while len(to_handle) > 0:
+            c = to_handle.pop()
+            if c._op > Cond._bool_base_:
+                key.append((c._op, len(c._operand)))
+                to_handle.extend(reversed(c._operand))
+            elif c._op < Cond.in_:
+                key.append((c._op, c._operand[0]._name))
+                values.append(c._operand[1])
+            elif Cond._inline(c._op, c._operand[1]):
+                key.append((c._op, c._operand[0]._name, len(c._operand[1])))
+                values.extend(c._operand[1])
+            else:
+                key.append((c._op, c._operand[0]._name, None))
+                values.append(c._operand[1])
+
+        for k, v in sorted(opt.items()):
+            if k in Cond._opt_values:
+                key.append(k)
+                values.append(v)
+            elif k in Cond._opt_pairs:
+                key.append((k, tuple(p[0] for p in v)))
+                values.extend(p[1] for p in v)
+            else:
+                key.append((k, v))
+
+        return tuple(key), values
+
+    @staticmethod
+    def optimize(cond):
+        """
+        rewrite a condition-tree into an equivalent but simpler one,
+        the original tree is not modified.
+
+        - nested groups with the same operator are flattened,
+          and a group with only one condition is replaced by it.
+        - duplicated conditions in a group are removed.
+        - in an 'and' group, bounds on one field are merged into
+          the strictest one, and >= with <= into 'between'.
+        - in an 'or' group, '==' and 'in_' on one field are merged
+          into one 'in_'.
+        """
+        if cond == None or cond._op < Cond._bool_base_:
+            return cond
+
+        op = cond._op
+        children = []
+        for c in cond._operand:
+            c = Cond.optimize(c)
+            if c._op == op:
+                # already flattened
+                children.extend(c._operand)
+            else:
+                children.append(c)
+
+        children = Cond.__dedupe(children)
+        if op == Cond.and__:
+            children = Cond.__merge_bounds(children)
+        else:
+            children = Cond.__merge_members(children)
+
+        if len(children) == 1:
+            return children[0]
+        return Cond(op, *children)
+
+    @staticmethod
+    def __key(c):
+        """
+        structural key of a condition with values, None when
+        any value is unhashable.
+        """
+        if c._op > Cond._bool_base_:
+            keys = tuple(Cond.__key(o) for o in c._operand)
+            return None if None in keys else (c._op, keys)
+        k = (c._op, c._operand[0]._name, c._operand[1])
+        try:
+            hash(k)
+        except TypeError:
+            return None
+        return k
+
+    @staticmethod
+    def __dedupe(children):
+        seen = set()
+        res = []
+        for c in children:
+            k = Cond.__key(c)
+            if k != None:
+                if k in seen:
+                    continue
+                seen.add(k)
+            res.append(c)
+        return res
+
+    @staticmethod
+    def __merge_bounds(children):
+        res = []
+        bounds = {}     # (name, is_lower) -> index in res
+        for c in Cond.__split_between(children):
+            if c._op not in (Cond.lt, Cond.le, Cond.gt, Cond.ge):
+                res.append(c)
+                continue
+
+            lower = c._op in (Cond.gt, Cond.ge)
+            key = (c._operand[0]._name, lower)
+            idx = bounds.get(key)
+            if idx == None:
+                bounds[key] = len(res)
+                res.append(c)
+                continue
+
+            old = res[idx]
+            v, old_v = c._operand[1], old._operand[1]
+            try:
+                if v == old_v:
+                    # exclusive one is stricter
+                    stricter = c._op in (Cond.lt, Cond.gt)
+                else:
+                    stricter = (v > old_v) if lower else (v < old_v)
+            except TypeError:
+                res.append(c)
+                continue
+            if stricter:
+                res[idx] = c
+
+        # a >= x AND a <= y  =>  a BETWEEN x AND y
+        for (name, lower), idx in bounds.items():
+            upper_idx = bounds.get((name, False))
+            if not lower or upper_idx == None:
+                continue
+            lo, hi = res[idx], res[upper_idx]
+            if lo._op == Cond.ge and hi._op == Cond.le:
+                res[idx] = Cond(Cond.between, lo._operand[0], (lo._operand[1], hi._operand[1]))
+                res[upper_idx] = None
+
+        return [c for c in res if c != None]
+
+    @staticmethod
+    def __split_between(children):
+        """
+        'between' is seen as a pair of bounds when merging
+        """
+        for c in children:
+            if c._op == Cond.between:
+                yield Cond(Cond.ge, c._operand[0], c._operand[1][0])
+                yield Cond(Cond.le, c._operand[0], c._operand[1][1])
+            else:
+                yield c
+
+    @staticmethod
+    def __merge_members(children):
+        count = collections.Counter()
+        vals = collections.defaultdict(list)
+        for c in children:
+            if c._op in (Cond.eq, Cond.in_):
+                name = c._operand[0]._name
+                count[name] += 1
+                vals[name].extend([c._operand[1]] if c._op == Cond.eq else c._operand[1])
+
+        res = []
+        merged = set()
+        for c in children:
+            if c._op not in (Cond.eq, Cond.in_) or count[c._operand[0]._name] == 1:
+                res.append(c)
+                continue
+
+            # merged into one 'in_' in place of the first one
+            name = c._operand[0]._name
+            if name not in merged:
+                merged.add(name)
+                try:
+                    v = tuple(dict.fromkeys(vals[name]))
+                except TypeError:
+                    v = tuple(vals[name])
+                res.append(Cond(Cond.in_, c._operand[0], v))
+        return res
+
+    @staticmethod
+    def to_cmd(model, cond, opt=None):
         """
         convert a condition to a command that
         can be used in querying database
+
+        'opt' is a dict of query options passed to _finish_cond,
+        ex. {"fields": ("name", "age")} for projection,
+        {"order_by": (("age", Cond.desc),)}, {"limit": 10, "offset": 20}.
+        Commands other than querying are composed with "action", ex.
+        {"action": "update", "set": (("age", 20),)}, {"action": "delete"}.
+
+        When statement-cache is enabled on that model,
+        the condition-tree would only be compiled once for each
+        shape, and later calls just bind new values to it.
+
+        When __toresdo_optimize__ is enabled on that model, the
+        condition-tree is rewritten by Cond.optimize first.
+        """
+        if not model._n_listener:
+            return Cond._to_cmd(model, cond, opt)
+
+        start = time.perf_counter()
+        stmt = Cond._to_cmd(model, cond, opt)
+        model._emit("compile", time.perf_counter() - start, label=model._stmt_label(stmt))
+        return stmt
+
+    @staticmethod
+    def _to_cmd(model, cond, opt):
+        if opt == None:
+            opt = {}
+        if model.__toresdo_optimize__:
+            cond = Cond.optimize(cond)
+
+        cache = model.stmt_cache()
+        if cache == None:
+            return Cond._compile(model, cond, opt, False)
+
+        key, values = Cond._shape(cond, opt)
+        tmpl = cache.get(key)
+        if tmpl == None:
+            tmpl = Cond._compile(model, cond, opt, True)
+            cache.put(key, tmpl)
+
+        return model._bind_cond(tmpl, values)
+
+    @staticmethod
+    def _compile(model, cond, opt, as_tmpl):
         """
+        traverse condition-tree and compose the command,
+        when 'as_tmpl' is True, values are replaced with Cond._Slot.
+        """
+        n_val = 0
         model_ctx = model._init_cond_ctx()
-        to_handle = [(Cond._Act._cond, cond, None, None, 0)]
+        to_handle = [(Cond._Act._cond, cond, None, None, 0)] if cond != None else []
         """
         traverse condition-tree, and
         call corresponding hooking functions
@@ -111,33 +409,71 @@ class Cond(object):
                         idx -= 1
                     to_handle.append((Cond._Act._in, None, rec[Cond.i_op], c._op, rec[Cond.i_idx]))
                 else:
-                    model_ctx = model._handle_cond(c._op, c._operand[0], c._operand[1], model_ctx, rec)
+                    v2 = c._operand[1]
+                    if c._op >= Cond.in_ and Cond._inline(c._op, v2):
+                        # a tuple of slots, one for each value
+                        if as_tmpl:
+                            v2 = tuple(Cond._Slot(n_val + i) for i in range(len(v2)))
+                        n_val += len(v2)
+                    else:
+                        if as_tmpl:
+                            v2 = Cond._Slot(n_val)
+                        n_val += 1
+                    model_ctx = model._handle_cond(c._op, c._operand[0], v2, model_ctx, rec)
             else:
                 raise Exception("Unknown Case.")
 
-        model_ctx = model._finish_cond(model_ctx)
+        if as_tmpl:
+            # values of options are bound after conditions, in the order of _shape
+            opt = dict(opt)
+            for k in sorted(opt):
+                if k in Cond._opt_values:
+                    opt[k] = Cond._Slot(n_val)
+                    n_val += 1
+                elif k in Cond._opt_pairs:
+                    opt[k] = tuple((p[0], Cond._Slot(n_val + i)) for i, p in enumerate(opt[k]))
+                    n_val += len(opt[k])
+
+        model_ctx = model._finish_cond(model_ctx, opt)
         return model_ctx
 
- 
+
+class FieldNotLoaded(AttributeError):
+    """
+    raised when accessing a field not loaded by
+    the query, ex. find(cond, fields=[...])
+    """
+    def __init__(self, model, name):
+        super(FieldNotLoaded, self).__init__(
+            "Field '{0}' of {1} is not loaded by this query.".format(name, model.__name__))
+
+
 class field(object):
     """
     this class represent a database field,
     used as a decorator in python.
     """
-    def __init__(self, pk=False, enable_type_check=True):
+    def __init__(self, pk=False, enable_type_check=True, index=False, unique=False):
         # TODO: handle primary-key
         self._pk = pk
         # TODO: add test case for type-filter
         self._type_chk = enable_type_check
+        # unique implies index
+        self._index = index or unique
+        self._unique = unique
 
         self._valid = []
+        # validators for a whole column of values
+        self._col_valid = []
+        # the last column validator is generated from a per-value one
+        self._col_generated = False
 
     def __call__(self, fn):
         """
         this function accepts another function(that what decorator means to be)
         and receive type/default-value from that function.
         """
-        # get name of this field 
+        # get name of this field
         self._name = fn.__name__
         # get type of this field
         ret = fn(None)
@@ -160,11 +496,11 @@ class field(object):
             return self
 
         """
-        call the hook(_get_field) provided by each model to get 
+        call the hook(_get_field) provided by each model to get
         the actual value
         """
         return obj._get_field(self._name)
-    
+
     def _check_type(self, obj, v):
         """
         private function wrapping actions required to
@@ -179,6 +515,19 @@ class field(object):
 
         return v
 
+    def _check_column(self, obj, values):
+        """
+        check a column of values at once, used by bulk
+        write paths instead of checking each value.
+        """
+        if self._type_chk and not set(map(type, values)) <= {self._type}:
+            raise Exception("Type Error.")
+
+        for f in self._col_valid:
+            f(obj, values)
+
+        return values
+
     def __set__(self, obj, v):
         """
         call the hook(_set_field) provided by each model to set
@@ -191,35 +540,81 @@ class field(object):
         add a new validator for this field
         """
         self._valid.append(fn)
+
+        # without batch form, a column is checked value by value.
+        def col_fn(obj, values):
+            for v in values:
+                fn(obj, v)
+        self._col_valid.append(col_fn)
+        self._col_generated = True
+        return self
+
+    def batch_validator(self, fn):
+        """
+        add the batch form of the last validator, which receives
+        a whole column of values, and is used instead of that
+        validator when checking a column.
+
+        When the last validator already has its batch form, this
+        is a new validator, and single value is checked as a
+        column with one value.
+        """
+        if self._col_generated:
+            self._col_valid[-1] = fn
+        else:
+            self._valid.append(lambda obj, v: fn(obj, (v,)))
+            self._col_valid.append(fn)
+        self._col_generated = False
         return self
 
+    """
+    sort order, used in 'order_by' of find()
+    """
+    def asc(self):
+        return (self, Cond.asc)
+
+    def desc(self):
+        return (self, Cond.desc)
+
     """
     comparison operators
-    
+
     These operators would generate Cond object for later usage.
-    """ 
+    """
     def __lt__(self, v):
         return Cond(Cond.lt, self, self._check_type(None, v))
 
     def __le__(self, v):
         return Cond(Cond.le, self, self._check_type(None, v))
-    
+
     def __eq__(self, v):
         return Cond(Cond.eq, self, self._check_type(None, v))
 
     def __ne__(self, v):
         return Cond(Cond.ne, self, self._check_type(None, v))
-    
+
     def __gt__(self, v):
         return Cond(Cond.gt, self, self._check_type(None, v))
-    
+
     def __ge__(self, v):
         return Cond(Cond.ge, self, self._check_type(None, v))
 
+    def in_(self, values):
+        return Cond(Cond.in_, self, tuple(self._check_column(None, tuple(values))))
+
+    def not_in(self, values):
+        return Cond(Cond.not_in, self, tuple(self._check_column(None, tuple(values))))
+
+    def between(self, low, high):
+        return Cond(Cond.between, self, (self._check_type(None, low), self._check_type(None, high)))
+
 
 class ConnPool(object):
     """
     Base implementation of Connection Pool
+
+    Indexes of available connections are kept in a free-list,
+    so both acquiring and giving back a connection are O(1).
     """
 
     """
@@ -227,63 +622,161 @@ class ConnPool(object):
     In 3.3, correct way for metaclass should be
         class A(metaclass=abc.ABCMeta):
             ...
-            
+
     However, Eclipse would complain about this.
     """
     __metaclass__ = abc.ABCMeta
-    
+
     # status of connection objects
     _busy = 0
     _aval = 1   # stands for 'available'
-    
+
     _idx_conn = 0
     _idx_status = 1
 
-    def __init__(self, klass, max_size=5):
+    def __init__(self, klass, max_size=5, timeout=None, thread_safe=False):
+        """
+        'timeout' is the default seconds to wait for a connection
+        when all of them are busy, only works when 'thread_safe'
+        is enabled, because no one would give back a connection
+        while we are waiting in single thread.
+        """
         self._buf = []
+        self._free = []
         self._max_sz = max_size
+        self._timeout = timeout
+        self._lock = threading.Condition() if thread_safe else None
+        self._n_waiter = 0
+        self._wait_time = 0.0
+        # key -> when it's acquired, only tracked when listened
+        self._held = {}
         self._producer = klass
         self._ctx = self._producer._new_conn_pool_ctx(self._producer.__toresdo_db_conn__)
-        
-    def _find_one(self):
-        r = [n for n in enumerate(self._buf) if n[1][ConnPool._idx_status] == ConnPool._aval]
-        # we have one available connection
-        if len(r):
-            self._buf[r[0][0]][ConnPool._idx_status] = ConnPool._busy
-            return r[0][0]
-
-        # we didn't have a stand-by connection, allocate a new one.
-        if len(self._buf) < self._max_sz:
-            self._buf.append([self._producer._new_conn(self._ctx), ConnPool._busy])
-            return len(self._buf) - 1
-
-        # maximun allowed connection is reached.
-        raise OverflowError("All connection is busy and max-conn is reached.")
+
+    def _take(self):
+        """
+        get index of an available connection, None when
+        max-conn is reached.
+        """
+        if len(self._free) > 0:
+            key = self._free.pop()
+        elif len(self._buf) < self._max_sz:
+            # we didn't have a stand-by connection, allocate a new one.
+            self._buf.append([self._alloc(), ConnPool._aval])
+            key = len(self._buf) - 1
+        else:
+            return None
+
+        self._buf[key][ConnPool._idx_status] = ConnPool._busy
+        return key
+
+    def _alloc(self):
+        """
+        create a new connection for '_take'
+        """
+        return self._producer._new_conn(self._ctx)
+
+    def _find_one(self, timeout=None, take=None):
+        """
+        'take' is the function to get an available connection,
+        '_take' by default.
+        """
+        if not self._producer._n_listener:
+            return self._wait_one(timeout, take)
+
+        start = time.perf_counter()
+        key = self._wait_one(timeout, take)
+        self._acquired(key, start)
+        return key
+
+    def _acquired(self, key, start):
+        now = time.perf_counter()
+        self._held[key] = now
+        self._producer._emit("acquire", now - start)
+
+    def _released(self, key):
+        start = self._held.pop(key, None)
+        if start != None:
+            self._producer._emit("release", time.perf_counter() - start)
+
+    def _wait_one(self, timeout, take):
+        take = take or self._take
+        key = take()
+        if key != None:
+            return key
+
+        if timeout == None:
+            timeout = self._timeout
+        if self._lock == None or not timeout:
+            # maximun allowed connection is reached.
+            raise OverflowError("All connection is busy and max-conn is reached.")
+
+        # wait for someone giving back a connection, lock should be held.
+        begin = time.monotonic()
+        self._n_waiter += 1
+        try:
+            while key == None:
+                remain = timeout - (time.monotonic() - begin)
+                if remain <= 0:
+                    raise OverflowError("Timeout when waiting for a connection.")
+                self._lock.wait(remain)
+                key = take()
+        finally:
+            self._n_waiter -= 1
+            self._wait_time += time.monotonic() - begin
+
+        return key
 
     def _give_back(self, key):
         if self._buf[key][ConnPool._idx_status] == ConnPool._aval:
             raise RuntimeError("Give back an available connection, maybe you release it twice.")
-        
+
         self._buf[key][ConnPool._idx_status] = ConnPool._aval
+        self._free.append(key)
+        if self._lock != None and self._n_waiter > 0:
+            self._lock.notify()
 
     def _close(self):
         for v in self._buf:
             # TODO: what if the connection status is busy.
             self._producer._del_conn(self._ctx, v[0])
-            
+
         self._buf.clear()
+        self._free.clear()
         self._producer._del_conn_pool_ctx(self._ctx)
         self._ctx = None
 
+    """
+    statistics of this pool
+    """
+    @property
+    def in_use(self):
+        return len(self._buf) - len(self._free)
+
+    @property
+    def idle(self):
+        return len(self._free)
+
+    @property
+    def waiters(self):
+        return self._n_waiter
+
+    @property
+    def wait_time(self):
+        """
+        total seconds spent on waiting for connections
+        """
+        return self._wait_time
+
     def __getitem__(self, key):
         return self._buf[key][ConnPool._idx_conn]
-    
+
     def __setitem__(self, key):
         """
         Avoid to modify any existing slot for connection-objects
         """
         raise Exception("Never modify connection-pool.")
-    
+
     def __delitem__(self, key):
         """
         Avoid to modify any existing slot for connection-objects
@@ -293,18 +786,18 @@ class ConnPool(object):
 
     """
     in a multi-threaded project, you will need to implement
-    locking mechanism in the two function below. Now the basic
-    implement is no concurrent access-control and should be
-    ok for tornado.
+    locking mechanism in the two function below, or just
+    enable 'thread_safe' in DefaultConnPool. Without it, there
+    is no concurrent access-control and should be ok for tornado.
     """
     @abc.abstractmethod
     def req(self):
         raise NotImplementedError()
 
-    @abc.abstractmethod    
+    @abc.abstractmethod
     def dispose(self, key):
         raise NotImplementedError()
-    
+
     @abc.abstractmethod
     def close_all(self):
         """
@@ -313,58 +806,592 @@ class ConnPool(object):
         """
         raise NotImplementedError()
 
+    """
+    Adapters request connections for reading and writing by
+    the two functions below, pools which separate readers from
+    writers should override them. Both are given back by 'dispose'.
+    """
+    def req_read(self):
+        return self.req()
+
+    def req_write(self):
+        return self.req()
+
+    def _share(self, klass):
+        """
+        called when model 'klass' shares this pool created
+        by another model with the same config.
+        """
+        pass
+
 
 class DefaultConnPool(ConnPool):
     """
     Default implementation of ConnPool
     """
+    def req(self, timeout=None):
+        if self._lock == None:
+            return self._find_one()
+
+        with self._lock:
+            return self._find_one(timeout)
+
+    def dispose(self, key):
+        if self._producer._n_listener:
+            self._released(key)
+
+        if self._lock == None:
+            return self._give_back(key)
+
+        with self._lock:
+            return self._give_back(key)
+
+    def close_all(self):
+        if self._lock == None:
+            return self._close()
+
+        with self._lock:
+            return self._close()
+
+
+class AsyncConnPool(ConnPool):
+    """
+    Connection pool for coroutines, ex. tornado handlers
+    running on asyncio.
+
+    When all connections are busy, 'acquire' parks the coroutine
+    in a FIFO queue instead of failing, and a connection given back
+    is handed to the first waiter directly.
+
+        async with pool.connection() as conn:
+            ...
+
+    'req' is still provided for synchronous callers, it never waits.
+    """
+    def __init__(self, klass, max_size=5, timeout=None):
+        super(AsyncConnPool, self).__init__(klass, max_size, timeout)
+        self._waiter = collections.deque()
+
     def req(self):
+        if len(self._waiter) > 0:
+            # never jump the queue
+            raise OverflowError("All connection is busy and max-conn is reached.")
         return self._find_one()
 
+    async def acquire(self, timeout=None):
+        if not self._producer._n_listener:
+            return await self._acquire(timeout)
+
+        start = time.perf_counter()
+        key = await self._acquire(timeout)
+        self._acquired(key, start)
+        return key
+
+    async def _acquire(self, timeout):
+        if len(self._waiter) == 0:
+            key = self._take()
+            if key != None:
+                return key
+
+        if timeout == None:
+            timeout = self._timeout
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiter.append(fut)
+        self._n_waiter += 1
+        begin = time.monotonic()
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise OverflowError("Timeout when waiting for a connection.")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # connection is handed to us right after we are cancelled.
+                self.dispose(fut.result())
+            raise
+        finally:
+            self._n_waiter -= 1
+            self._wait_time += time.monotonic() - begin
+
     def dispose(self, key):
-        return self._give_back(key)
-    
+        if self._buf[key][ConnPool._idx_status] == ConnPool._aval:
+            raise RuntimeError("Give back an available connection, maybe you release it twice.")
+        if self._producer._n_listener:
+            self._released(key)
+
+        # waiters given up are skipped
+        while len(self._waiter) > 0:
+            fut = self._waiter.popleft()
+            if not fut.done():
+                fut.set_result(key)
+                return
+
+        self._give_back(key)
+
+    def connection(self, timeout=None):
+        """
+        context to acquire a connection, which would be
+        given back on exit.
+        """
+        return _AsyncConnCtx(self, timeout)
+
     def close_all(self):
+        while len(self._waiter) > 0:
+            self._waiter.popleft().cancel()
         self._close()
 
 
+class _AsyncConnCtx(object):
+    """
+    context returned by AsyncConnPool.connection
+    """
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._key = None
+
+    async def __aenter__(self):
+        self._key = await self._pool.acquire(self._timeout)
+        return self._pool[self._key]
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.dispose(self._key)
+        self._key = None
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that drops the least recently used
+    entry once 'max_size' is reached, and entries expire
+    after 'ttl' seconds when provided.
+
+    'hits' and 'misses' are counted in 'get'. It's safe to
+    share among threads, ex. workers of AdapterBase._offload.
+    """
+    def __init__(self, max_size=128, ttl=None):
+        self._buf = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                v, deadline = self._buf[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if deadline != None and deadline < time.monotonic():
+                del self._buf[key]
+                self.misses += 1
+                return None
+
+            self._buf.move_to_end(key)
+            self.hits += 1
+            return v
+
+    def put(self, key, v):
+        with self._lock:
+            self._buf[key] = (v, time.monotonic() + self.ttl if self.ttl != None else None)
+            self._buf.move_to_end(key)
+            while len(self._buf) > self.max_size:
+                self._buf.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._buf.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buf)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._buf
+
+
+class Event(object):
+    """
+    An instrumentation event passed to listeners of models.
+
+    'kind' is one of:
+    - compile: composing a statement by Cond.to_cmd.
+    - acquire: waiting for a connection from pool.
+    - execute: running a statement.
+    - fetch: fetching a batch of rows, 'rows' is the size of it.
+    - release: holding a connection, from acquired to given back.
+    - save: writing models, 'rows' is count of them.
+
+    'duration' is in seconds, 'label' identifies the statement
+    without values, ex. SQL with qmarks, None when not related
+    to a statement.
+    """
+    __slots__ = ("kind", "model", "duration", "rows", "label")
+
+    def __init__(self, kind, model, duration, rows=None, label=None):
+        self.kind = kind
+        self.model = model
+        self.duration = duration
+        self.rows = rows
+        self.label = label
+
+    def __repr__(self):
+        return "<Event {0} {1} {2:.6f}s>".format(self.kind, self.model.__name__, self.duration)
+
+
+class StatAggregator(object):
+    """
+    An in-memory listener keeping durations of events by
+    (kind, model name, label), and reporting percentiles.
+
+        agg = StatAggregator()
+        User.add_listener(agg)
+        ...
+        agg.report()
+
+    Only the latest 'max_samples' durations of each key are kept
+    for percentiles, while counts and rows cover all events.
+    """
+    def __init__(self, max_samples=1000):
+        self._max_samples = max_samples
+        self._samples = {}
+        self._count = collections.Counter()
+        self._rows = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, ev):
+        key = (ev.kind, ev.model.__name__, ev.label)
+        with self._lock:
+            buf = self._samples.get(key)
+            if buf == None:
+                buf = self._samples[key] = collections.deque(maxlen=self._max_samples)
+            buf.append(ev.duration)
+            self._count[key] += 1
+            if ev.rows != None:
+                self._rows[key] += ev.rows
+
+    @staticmethod
+    def _percentile(sorted_values, q):
+        return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+    def report(self):
+        """
+        return a dict keyed by (kind, model name, label), with
+        'count', 'rows', 'p50' and 'p99' in seconds.
+        """
+        with self._lock:
+            res = {}
+            for key, buf in self._samples.items():
+                values = sorted(buf)
+                res[key] = {
+                    "count": self._count[key],
+                    "rows": self._rows[key],
+                    "p50": self._percentile(values, 0.5),
+                    "p99": self._percentile(values, 0.99),
+                }
+            return res
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._count.clear()
+            self._rows.clear()
+
+
+_identity_map = contextvars.ContextVar("toresdo_identity_map", default=None)
+
+
+class IdentityMap(object):
+    """
+    A unit of work, within which models loaded from database
+    are deduplicated by their primary-key: a row already loaded
+    is handed out as the same model, and find_one by primary-key
+    returns that model without querying.
+
+        with IdentityMap():
+            u1 = User.find_one(User.uid == 1)
+            u2 = User.find_one(User.uid == 1)  # no query, u1 is u2
+
+    The map is scoped by contextvars. Asyncio tasks started inside
+    the block, and workers of AdapterBase._offload, share the map of
+    that block, so it's locked for them. Threads started otherwise
+    never see it. Partially loaded models are never put into the map.
+    """
+    def __init__(self):
+        self._buf = {}
+        self._token = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def current():
+        """
+        get the identity-map of current context, None when no one.
+        """
+        return _identity_map.get()
+
+    def get(self, klass, pk):
+        with self._lock:
+            return self._buf.get((klass._table_cls(), pk))
+
+    def add(self, obj):
+        pk_name = obj.__class__._pk_name
+        if pk_name == None:
+            return
+        pk = getattr(obj, pk_name)
+        if pk != None:
+            with self._lock:
+                self._buf[(obj._table_cls(), pk)] = obj
+
+    def _merge(self, obj, fields):
+        """
+        replace a newly loaded model with the one already in map.
+        """
+        pk_name = obj.__class__._pk_name
+        if pk_name == None or (fields != None and pk_name not in fields):
+            return obj
+
+        pk = getattr(obj, pk_name)
+        key = (obj._table_cls(), pk)
+        with self._lock:
+            old = self._buf.get(key)
+            if old != None:
+                return old
+            if fields == None and pk != None:
+                self._buf[key] = obj
+        return obj
+
+    def clear(self):
+        with self._lock:
+            self._buf.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buf)
+
+    def __enter__(self):
+        self._token = _identity_map.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _identity_map.reset(self._token)
+        self._token = None
+        self.clear()
+
+
 class Session(collections.Iterator):
     """
     Session
-    
+
     used to manage database resource, like connection.
+
+    Rows are fetched in batches of 'batch_size' into an internal
+    buffer, and handed out one by one from that buffer.
+
+    When 'fields' is provided, only those fields are loaded, and
+    accessing other fields of returned models raises FieldNotLoaded.
+
+    'order_by' is a list of fields, or (field, Cond.desc) pairs
+    like User.age.desc(). 'limit' and 'offset' are pushed down
+    to database too.
+
+    Besides 'for', a session could be looped by 'async for', then
+    looping begins with _pre_loop_async, which could wait for a
+    connection, and batches are fetched through _next_batch_async
+    without blocking the event loop.
+
+    When result-cache of the model is enabled, a completely looped
+    result, or one reaching 'limit', is cached, and later sessions
+    with the same statement are served from that cache.
+
+    Inside an IdentityMap, rows already loaded are returned as
+    the models in that map.
     """
-    def __init__(self, klass, cond=None, cb=None):
+    def __init__(self, klass, cond=None, cb=None, batch_size=None, fields=None,
+                 order_by=None, limit=None, offset=None):
         self._klass = klass
         self._cond = cond
         self._cb = cb
+        self._batch_sz = batch_size if batch_size else klass.__toresdo_batch_size__
+
+        self._opt = {}
+        self._fields = None
+        if fields:
+            self._fields = tuple(f._name for f in fields)
+            self._opt["fields"] = self._fields
+        if order_by:
+            self._opt["order_by"] = tuple((o[0]._name, o[1]) if type(o) is tuple else (o._name, Cond.asc)
+                                          for o in order_by)
+        if limit != None:
+            self._opt["limit"] = limit
+        if offset != None:
+            self._opt["offset"] = offset
 
         self._ctx = None
+        self._buf = []
+        self._pos = 0
+        self._done = False
+        self._n_fetched = 0
+
+        self._cache_key = None
+        self._collect = None
+
+        self._imap = _identity_map.get()
+        # label of the statement for instrumentation
+        self._label = None
 
     def __next__(self):
-        if not self._ctx:
-            self._ctx = self._klass._pre_loop(Cond.to_cmd(self._klass, self._cond))
-            if not self._ctx:
-                raise Exception("loop initialization failed.")
+        if self._pos >= len(self._buf):
+            self._fill()
 
-        try:
-            res = self._klass._next_elm(self._ctx)
-            if not res:
-                """
-                some db-driver would only return nothing but not raise
-                StopIteration exception. We unify looping behavior here.
-                """
-                raise StopIteration
+        res = self._buf[self._pos]
+        self._pos += 1
 
-        except StopIteration as e:
+        # wrapped raw data with model
+        obj = self._klass._new_row(res, self._fields)
+        if self._imap != None:
+            obj = self._imap._merge(obj, self._fields)
+        return obj
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._pos >= len(self._buf):
+            if self._done:
+                raise StopAsyncIteration
+
+            if not await self._start_async():
+                start = time.perf_counter() if self._klass._n_listener else None
+                self._fetched(await self._klass._next_batch_async(self._ctx, self._batch_sz), start)
+            if len(self._buf) == 0:
+                raise StopAsyncIteration
+
+        res = self._buf[self._pos]
+        self._pos += 1
+
+        obj = self._klass._new_row(res, self._fields)
+        if self._imap != None:
+            obj = self._imap._merge(obj, self._fields)
+        return obj
+
+    def _fill(self):
+        """
+        fetch next batch of raw data into buffer
+        """
+        if self._done:
+            raise StopIteration
+
+        if not self._start():
+            start = time.perf_counter() if self._klass._n_listener else None
+            try:
+                batch = self._klass._next_batch(self._ctx, self._batch_sz)
+            except StopIteration:
+                batch = []
+            self._fetched(batch, start)
+
+        if len(self._buf) == 0:
+            raise StopIteration
+
+    def _start(self):
+        """
+        compose the query and begin looping when not yet.
+
+        Return True when the whole result is served from cache.
+        """
+        if self._ctx:
+            return False
+
+        stmt = self._compose()
+        if stmt == None:
+            return True
+        self._begin(self._klass._pre_loop(stmt, self._opt))
+        return False
+
+    async def _start_async(self):
+        """
+        async version of _start.
+        """
+        if self._ctx:
+            return False
+
+        stmt = self._compose()
+        if stmt == None:
+            return True
+        self._begin(await self._klass._pre_loop_async(stmt, self._opt))
+        return False
+
+    def _compose(self):
+        """
+        return the statement to run, None when served from cache.
+        """
+        stmt = Cond.to_cmd(self._klass, self._cond, self._opt)
+        if self._klass._n_listener:
+            self._label = self._klass._stmt_label(stmt)
+
+        cache = self._klass.result_cache()
+        if cache != None:
+            self._cache_key = (self._klass._stmt_key(stmt),
+                               tuple(sorted(self._opt.items())),
+                               self._klass._data_version())
+            rows = cache.get(self._cache_key)
+            if rows != None:
+                self._buf = self._klass._copy_rows(rows)
+                self._pos = 0
+                self._done = True
+                return None
+            self._collect = []
+        return stmt
+
+    def _begin(self, ctx):
+        self._ctx = ctx
+        if not self._ctx:
+            raise Exception("loop initialization failed.")
+        self._klass._set_batch_size(self._ctx, self._batch_sz)
+        return False
+
+    def _fetched(self, batch, start=None):
+        """
+        'start' is when fetching begins, only provided when listened.
+        """
+        self._buf = batch
+        self._pos = 0
+        if start != None:
+            self._klass._emit("fetch", time.perf_counter() - start, len(batch), self._label)
+
+        if self._collect != None:
+            self._collect.extend(batch)
+            if len(self._collect) > self._klass.__toresdo_result_cache_max_rows__:
+                # too large to cache
+                self._collect = None
+
+        # no more rows after a short batch, or when 'limit' is reached
+        self._n_fetched += len(batch)
+        last = len(batch) < self._batch_sz
+        if "limit" in self._opt and self._n_fetched >= self._opt["limit"]:
+            last = True
+
+        if last:
+            if self._collect != None:
+                self._klass.result_cache().put(self._cache_key, self._klass._copy_rows(self._collect))
+
+            # the last batch, release resource as soon as possible.
+            self.close()
+
+    def close(self):
+        """
+        stop looping and release resource held by this session.
+        """
+        if self._ctx:
             self._klass._post_loop(self._ctx)
             self._ctx = None
-            raise e
-
-        # wrapped raw data with model
-        m = self._klass()
-        m._attach_model(res)
-        return m
+        self._done = True
+        # result not looped completely is never cached
+        self._collect = None
 
 
 class AdapterBase(object):
@@ -377,6 +1404,7 @@ class AdapterBase(object):
     - _init_cls
     - _init_obj
     - _attach_model
+    - _new_row
     ========== field access
     - _set_field
     - _get_field
@@ -386,10 +1414,20 @@ class AdapterBase(object):
     - _leave_group
     - _handle_cond
     - _finish_cond
+    - _bind_cond (required when statement-cache is enabled)
     ========== loop query result
     - _pre_loop
+    - _pre_loop_async
     - _next_elm
+    - _next_batch
+    - _next_batch_async
+    - _set_batch_size
     - _post_loop
+    ========== result cache
+    - _stmt_key
+    - _copy_rows
+    ========== instrumentation
+    - _stmt_label
     ========== connection pool management
     - _cmp_conn
     _ _new_conn
@@ -397,7 +1435,7 @@ class AdapterBase(object):
     _ _new_conn_pool_ctx
     - _del_conn_pool_ctx
     """
-    
+
     """
     Optional Callbacks
     """
@@ -412,7 +1450,118 @@ class AdapterBase(object):
     def _new_conn_pool_ctx(klass, conn_config): pass
     @classmethod
     def _del_conn_pool_ctx(klass, ctx): pass
- 
+    @classmethod
+    def _set_batch_size(klass, loop_ctx, size): pass
+
+    @classmethod
+    def _check_rows(klass, rows, names=None):
+        """
+        validate rows column by column.
+
+        'rows' is a list of tuples whose values are ordered as 'names',
+        or a list of dicts keyed by field name when 'names' is None,
+        and only provided values are checked.
+        """
+        if len(rows) == 0:
+            return
+
+        if names == None:
+            names = set()
+            for r in rows:
+                names.update(r)
+            cols = [[r[k] for r in rows if k in r] for k in names]
+        else:
+            cols = zip(*rows)
+
+        for k, col in zip(names, cols):
+            fld = getattr(klass, k, None)
+            if not isinstance(fld, field):
+                raise Exception("Unknown field {0} of {1}.".format(k, klass.__name__))
+            fld._check_column(None, col)
+
+    @classmethod
+    def _index_list(klass, fields):
+        """
+        collect indexes declared on fields and model, return
+        a list of (tuple of field names, unique)
+        """
+        idx = [((k,), v._unique) for k, v in fields.items() if v._index]
+        idx.extend((tuple(v), False) for v in klass.__toresdo_index__)
+        idx.extend((tuple(v), True) for v in klass.__toresdo_unique_index__)
+
+        for names, _ in idx:
+            for k in names:
+                if k not in fields:
+                    raise Exception("Unknown field {0} to index in {1}.".format(k, klass.__name__))
+        return idx
+
+    @classmethod
+    def _stmt_key(klass, stmt):
+        """
+        convert a composed statement to a hashable key
+        """
+        return repr(stmt)
+
+    @classmethod
+    def _copy_rows(klass, rows):
+        """
+        copy raw rows put into or got from result-cache, raw
+        rows which could be modified through models should be
+        copied by adapters.
+        """
+        return rows
+
+    @classmethod
+    def _new_row(klass, raw, fields=None):
+        """
+        wrap raw data fetched from database with model,
+        adapters could override it with a lighter way.
+
+        'fields' is the name list of loaded fields, None for all.
+        """
+        m = klass()
+        m._attach_model(raw)
+        return m
+
+    @classmethod
+    def _next_batch(klass, loop_ctx, size):
+        """
+        default implementation based on _next_elm, adapters
+        should override it when the driver could fetch many
+        rows at once.
+        """
+        batch = []
+        while len(batch) < size:
+            try:
+                res = klass._next_elm(loop_ctx)
+            except StopIteration:
+                break
+            if not res:
+                """
+                some db-driver would only return nothing but not raise
+                StopIteration exception. We unify looping behavior here.
+                """
+                break
+            batch.append(res)
+        return batch
+
+    @classmethod
+    async def _pre_loop_async(klass, stmt, opt):
+        """
+        begin looping for 'async for', default implementation
+        calls _pre_loop directly. Adapters using ConnPool should
+        await AsyncConnPool.acquire here when configured.
+        """
+        return klass._pre_loop(stmt, opt)
+
+    @classmethod
+    async def _next_batch_async(klass, loop_ctx, size):
+        """
+        default implementation calls _next_batch directly,
+        adapters with asynchronous driver should override it.
+        """
+        return klass._next_batch(loop_ctx, size)
+
 
     """
     Required Callbacks
@@ -434,14 +1583,16 @@ class AdapterBase(object):
     def _leave_group(klass, model_ctx, ctx): raise NotImplementedError()
     @classmethod
     def _handle_cond(klass, op, fld, v2, model_ctx, ctx): raise NotImplementedError()
-    @classmethod 
-    def _finish_cond(klass, model_ctx): raise NotImplementedError()
     @classmethod
-    def _pre_loop(klass, model_ctx): raise NotImplementedError()
+    def _finish_cond(klass, model_ctx, opt): raise NotImplementedError()
+    @classmethod
+    def _pre_loop(klass, model_ctx, opt): raise NotImplementedError()
     @classmethod
     def _next_elm(klass, loop_ctx): raise NotImplementedError()
     @classmethod
-    def _post_loop(klass, loop_ctx): raise NotImplementedError() 
+    def _post_loop(klass, loop_ctx): raise NotImplementedError()
+    @classmethod
+    def _bind_cond(klass, tmpl, values): raise NotImplementedError()
 
     """
     Class Type of connection-pool,
@@ -450,62 +1601,139 @@ class AdapterBase(object):
     """
     __conn_pool_cls__ = DefaultConnPool
 
-    def __init__(self, **kwargs):
-        if self.__class__.__name__ == "AdapterBase":
+    """
+    keyword arguments passed to __conn_pool_cls__ when
+    creating connection pool, ex. max_size, timeout, thread_safe
+    """
+    __conn_pool_opt__ = {}
+
+    """
+    Max count of compiled statements cached for each model,
+    0 to disable statement-cache. Model enabling it should
+    provide _bind_cond.
+    """
+    __toresdo_stmt_cache_size__ = 0
+
+    """
+    Count of rows fetched at once when looping
+    query result, could be overridden in each find().
+    """
+    __toresdo_batch_size__ = 100
+
+    """
+    Read-through cache of query results, 0 to disable it.
+    Cached results expire after 'ttl' seconds (None for never),
+    and are invalidated by any write through this model. Results
+    with more than 'max_rows' rows are never cached.
+    """
+    __toresdo_result_cache_size__ = 0
+    __toresdo_result_cache_ttl__ = None
+    __toresdo_result_cache_max_rows__ = 1000
+
+    """
+    Count of worker threads to offload blocking queries, 0 to
+    disable it. When enabled, find, find_one and save return
+    futures run on a ThreadPoolExecutor owned by this model.
+    """
+    __toresdo_offload__ = 0
+    _executor_lock = threading.Lock()
+    # guards per-model caches and __data_version__
+    _cache_lock = threading.Lock()
+
+    """
+    rewrite conditions by Cond.optimize before compiling them.
+    """
+    __toresdo_optimize__ = False
+
+    # name of the primary-key field, resolved in _prepare
+    _pk_name = None
+
+    # count of listeners attached to any model, nothing is
+    # measured when it's 0.
+    _n_listener = 0
+
+    """
+    composite indexes of this model, a list of
+    field-name tuples, ex. [("name", "age")]
+    """
+    __toresdo_index__ = []
+    __toresdo_unique_index__ = []
+
+    @classmethod
+    def _prepare(klass):
+        """
+        initialize this model when it's not yet, which would be
+        triggered by the first instance, or class-level exported
+        functions like save_many.
+        """
+        if klass.__name__ == "AdapterBase":
             raise Exception("Do not initialize AdapterBase.")
-        
-        if not issubclass(self.__class__.__conn_pool_cls__, ConnPool):
+
+        if not issubclass(klass.__conn_pool_cls__, ConnPool):
             raise Exception("Unknown type of connection-pool class.")
 
-        if not self.__class__._is_cls_inited():
-            """
-            Preparation for connection pool
-            
-            We will look for any existing pool through mro,
-            and make sure the connection with same address
-            is not initialized yet. Once not initialized yet,
-            we will allocate one.
-            """
-            if (not hasattr(self.__class__, "__toresdo_db_conn_table__") or
-                self.__class__.__toresdo_db_conn_table__ == None):
-                for cls in AdapterBase.__subclasses__():
-                    if issubclass(self.__class__, cls):
-                        setattr(cls, "__toresdo_db_conn_table__", [])
-                        break
-
-                if (not hasattr(self.__class__, "__toresdo_db_conn_table__") or
-                    self.__class__.__toresdo_db_conn_table__ == None):
-                    raise Exception("Unable to create the table of connection-pools for this model {0}.".format(self.__class__.__name__))
-
-            self.__class__.__conn_pool__ = None
-            # check if connection-pool with identical config is already initialized.
-            for v in self.__toresdo_db_conn_table__:
-                if self.__class__._cmp_conn(self.__class__.__toresdo_db_conn__, v[0]) == 0:
-                    self.__class__.__conn_pool__ = v[1]
+        if klass._is_cls_inited():
+            return
+
+        """
+        Preparation for connection pool
+
+        We will look for any existing pool through mro,
+        and make sure the connection with same address
+        is not initialized yet. Once not initialized yet,
+        we will allocate one.
+        """
+        if (not hasattr(klass, "__toresdo_db_conn_table__") or
+            klass.__toresdo_db_conn_table__ == None):
+            for cls in AdapterBase.__subclasses__():
+                if issubclass(klass, cls):
+                    setattr(cls, "__toresdo_db_conn_table__", [])
                     break
-                        
-            if self.__class__.__conn_pool__ == None:
-                # create a new pool based on callback
-                self.__class__.__conn_pool__ = self.__class__.__conn_pool_cls__(self.__class__)
 
-                # register this new pool
-                self.__toresdo_db_conn_table__.append((self.__class__.__toresdo_db_conn__, self.__class__.__conn_pool__))
+            if (not hasattr(klass, "__toresdo_db_conn_table__") or
+                klass.__toresdo_db_conn_table__ == None):
+                raise Exception("Unable to create the table of connection-pools for this model {0}.".format(klass.__name__))
+
+        klass.__conn_pool__ = None
+        # check if connection-pool with identical config is already initialized.
+        for v in klass.__toresdo_db_conn_table__:
+            if klass._cmp_conn(klass.__toresdo_db_conn__, v[0]) == 0:
+                klass.__conn_pool__ = v[1]
+                klass.__conn_pool__._share(klass)
+                break
+
+        if klass.__conn_pool__ == None:
+            # create a new pool based on callback
+            klass.__conn_pool__ = klass.__conn_pool_cls__(klass, **klass.__conn_pool_opt__)
+
+            # register this new pool
+            klass.__toresdo_db_conn_table__.append((klass.__toresdo_db_conn__, klass.__conn_pool__))
+
+            if klass.__conn_pool__ == None:
+                raise Exception("Unable to create connection pool for this model {0}".format(klass.__name__))
+
+        # generate a dict of field
+        fields = {}
+        for k,v in klass.__dict__.items():
+            if issubclass(type(v), field):
+                fields.update({k: v})
 
-                if self.__class__.__conn_pool__ == None:
-                    raise Exception("Unable to create connection pool for this model {0}".format(self.__class__.__name__))
+        # pass field list to model-implementation
+        klass._init_cls(fields)
 
-            # generate a dict of field
-            fields = {}
-            for k,v in self.__class__.__dict__.items():
-                if issubclass(type(v), field):
-                    fields.update({k: v})
+        if not klass._is_cls_inited():
+            # Error check, make sure model is correctly initialized
+            raise Exception("Not initialized.")
 
-            # pass field list to model-implementation
-            self.__class__._init_cls(fields)
+        # adapters might add builtin primary-key in _init_cls
+        klass._pk_name = None
+        for k, v in klass.__dict__.items():
+            if issubclass(type(v), field) and v._pk:
+                klass._pk_name = k
+                break
 
-            if not self.__class__._is_cls_inited():
-                # Error check, make sure model is correctly initialized
-                raise Exception("Not initialized.")
+    def __init__(self, **kwargs):
+        self.__class__._prepare()
 
         # preparation for each instance
         self._init_obj()
@@ -514,18 +1742,217 @@ class AdapterBase(object):
         for k, v in kwargs.items():
             if hasattr(self.__class__, k) and type(getattr(self.__class__, k)) is field:
                 setattr(self, k, v)
-                
+
 
     """
     Exported Functions
     """
     @classmethod
-    def find(klass, cond=None, cb=None):
-        return Session(klass, cond, cb)
+    def find(klass, cond=None, cb=None, batch_size=None, fields=None,
+             order_by=None, limit=None, offset=None):
+        """
+        return a Session to loop through the result, or a future of
+        the list of models when offloaded.
+        """
+        klass._prepare()
+        s = Session(klass, cond, cb, batch_size, fields, order_by, limit, offset)
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(list, s)
+        return s
+
+    @classmethod
+    def find_one(klass, cond=None, cb=None, fields=None, order_by=None):
+        """
+        return the first model matching 'cond', None when nothing
+        is found. When offloaded, return a future of it.
+        """
+        klass._prepare()
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(klass.__find_one, cond, cb, fields, order_by)
+        return klass.__find_one(cond, cb, fields, order_by)
+
+    @classmethod
+    def __find_one(klass, cond, cb, fields, order_by):
+        imap = _identity_map.get()
+        if imap != None and type(cond) is Cond and cond._op == Cond.eq:
+            # lookup by primary-key, try the identity-map first
+            fld = cond._operand[0]
+            if klass._pk_name != None and isinstance(fld, field) and fld._name == klass._pk_name:
+                obj = imap.get(klass, cond._operand[1])
+                if obj != None:
+                    return obj
+
+        s = Session(klass, cond, cb, batch_size=1, fields=fields, order_by=order_by, limit=1)
+        try:
+            return next(s, None)
+        finally:
+            s.close()
+
+    @classmethod
+    def seek(klass, order_by, last=None, cond=None, limit=20, fields=None):
+        """
+        keyset pagination: get the page right after 'last', which
+        is the last model of previous page.
+
+        Instead of skipping 'offset' rows, the sort key of 'last'
+        is turned into a condition, so a deep page costs the same
+        as the first one. 'order_by' should identify a row uniquely,
+        ex. end with the primary key.
+
+        Sort keys can't be None in 'last', NULL never matches a
+        comparison, and rows after it would be skipped silently.
+        """
+        if last != None:
+            keys = [o if type(o) is tuple else (o, Cond.asc) for o in order_by]
+            for fld, _ in keys:
+                if getattr(last, fld._name) == None:
+                    raise Exception("Unable to seek after {0} with None in sort key {1}.".format(
+                                    klass.__name__, fld._name))
+
+            # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...
+            after = []
+            for i, (fld, order) in enumerate(keys):
+                op = Cond.gt if order == Cond.asc else Cond.lt
+                c = [Cond(Cond.eq, f, getattr(last, f._name)) for f, _ in keys[:i]]
+                c.append(Cond(op, fld, getattr(last, fld._name)))
+                after.append(c[0] if len(c) == 1 else Cond.group(Cond.and__, *c))
+
+            after = after[0] if len(after) == 1 else Cond.group(Cond.or__, *after)
+            cond = after if cond == None else Cond.group(Cond.and__, cond, after)
+
+        return klass.find(cond, batch_size=limit, fields=fields, order_by=order_by, limit=limit)
+
+    @classmethod
+    def stmt_cache(klass):
+        """
+        get the statement-cache of this model, None when disabled.
+        """
+        klass = klass._table_cls()
+        if klass.__toresdo_stmt_cache_size__ <= 0:
+            return None
+
+        # each model owns its cache, never share it with base class.
+        if "__stmt_cache__" not in klass.__dict__:
+            with AdapterBase._cache_lock:
+                if "__stmt_cache__" not in klass.__dict__:
+                    klass.__stmt_cache__ = LRUCache(klass.__toresdo_stmt_cache_size__)
+        return klass.__stmt_cache__
+
+    @classmethod
+    def result_cache(klass):
+        """
+        get the result-cache of this model, None when disabled.
+        """
+        klass = klass._table_cls()
+        if klass.__toresdo_result_cache_size__ <= 0:
+            return None
+
+        if "__result_cache__" not in klass.__dict__:
+            with AdapterBase._cache_lock:
+                if "__result_cache__" not in klass.__dict__:
+                    klass.__result_cache__ = LRUCache(klass.__toresdo_result_cache_size__,
+                                                      klass.__toresdo_result_cache_ttl__)
+        return klass.__result_cache__
+
+    @classmethod
+    def add_listener(klass, fn):
+        """
+        'fn(event)' would be called for each instrumentation
+        Event of this model and its subclasses.
+        """
+        if "__listeners__" not in klass.__dict__:
+            klass.__listeners__ = []
+        klass.__listeners__.append(fn)
+        AdapterBase._n_listener += 1
+
+    @classmethod
+    def remove_listener(klass, fn):
+        klass.__dict__.get("__listeners__", []).remove(fn)
+        AdapterBase._n_listener -= 1
+
+    @classmethod
+    def _emit(klass, kind, duration, rows=None, label=None):
+        """
+        pass an event to listeners, callers should check
+        '_n_listener' before measuring anything.
+        """
+        ev = None
+        for cls in klass.__mro__:
+            for fn in cls.__dict__.get("__listeners__", ()):
+                if ev == None:
+                    ev = Event(kind, klass._table_cls(), duration, rows, label)
+                fn(ev)
 
     @classmethod
-    def find_one(klass, cond=None, cb=None):
-        return next(klass.find(cond, cb))
+    def _stmt_label(klass, stmt):
+        """
+        label a composed statement without its values,
+        used to group instrumentation events.
+        """
+        return repr(stmt)
+
+    @classmethod
+    def _changes(klass, changes):
+        """
+        check keyword arguments of 'update', return (name, value)
+        pairs ordered by name.
+        """
+        if len(changes) == 0:
+            raise Exception("Nothing to update for {0}.".format(klass.__name__))
+
+        res = []
+        for k in sorted(changes):
+            fld = getattr(klass, k, None)
+            if not isinstance(fld, field):
+                raise Exception("Unknown field {0} of {1}.".format(k, klass.__name__))
+            res.append((k, fld._check_type(None, changes[k])))
+        return tuple(res)
+
+    @classmethod
+    def _offload(klass, fn, *args):
+        """
+        run 'fn' on the executor of this model with current context,
+        an asyncio future is returned when called in a running event
+        loop, else a concurrent.futures.Future.
+        """
+        klass = klass._table_cls()
+        if "__executor__" not in klass.__dict__:
+            with AdapterBase._executor_lock:
+                # might be created by another thread while waiting
+                if "__executor__" not in klass.__dict__:
+                    klass.__executor__ = concurrent.futures.ThreadPoolExecutor(
+                        klass.__toresdo_offload__, thread_name_prefix="toresdo-" + klass.__name__)
+
+        # context variables, ex. IdentityMap, are kept in workers
+        ctx = contextvars.copy_context()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return klass.__executor__.submit(ctx.run, fn, *args)
+        return loop.run_in_executor(klass.__executor__, ctx.run, fn, *args)
+
+    @classmethod
+    def _table_cls(klass):
+        """
+        the model owning the table. Adapters might generate
+        subclasses of a model, ex. for fetched rows, and those
+        subclasses set '_row_of' to their model.
+        """
+        return klass.__dict__.get("_row_of", klass)
+
+    @classmethod
+    def _data_version(klass):
+        return klass._table_cls().__dict__.get("__data_version__", 0)
+
+    @classmethod
+    def _touch(klass):
+        """
+        should be called by adapters after writing through this
+        model, cached results of older version are never used.
+        """
+        klass = klass._table_cls()
+        with AdapterBase._cache_lock:
+            klass.__data_version__ = klass.__dict__.get("__data_version__", 0) + 1
 
     @classmethod
     def release(klass):
@@ -539,11 +1966,16 @@ class AdapterBase(object):
                 local_sub = c.__subclasses__()
                 sub.extend(local_sub)
                 to_trace.extend(local_sub)
-                
+
             return list(set(sub))
-        
+
         # call _uninit_cls on each class
         for cls in reversed(get_related_classes(klass)):
+            if "__executor__" in cls.__dict__:
+                # offloaded queries should be done before closing connections
+                cls.__executor__.shutdown(wait=True)
+                del cls.__executor__
+
             cls._uninit_cls()
             # release connection-pool
             if hasattr(cls, "__conn_pool__") and cls.__conn_pool__ != None:
@@ -552,4 +1984,8 @@ class AdapterBase(object):
 
             if hasattr(cls, "__toresdo_db_conn_table__") and cls.__toresdo_db_conn_table__ != None:
                 cls.__toresdo_db_conn_table__.clear()
-    
\ No newline at end of file
+
+            if "__stmt_cache__" in cls.__dict__:
+                cls.__stmt_cache__.clear()
+            if "__result_cache__" in cls.__dict__:
+                cls.__result_cache__.clear()
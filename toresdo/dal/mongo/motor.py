@@ -5,22 +5,43 @@ Created on Aug 15, 2013
 '''
 
 from __future__ import absolute_import
+import asyncio
+import inspect
+import time
 from toresdo.dal import AdapterBase
 from toresdo.dal import field 
 from toresdo.dal import Cond
+from toresdo.dal import FieldNotLoaded
 from bson import ObjectId
+from pymongo import InsertOne
+from pymongo import UpdateOne
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 
 
 class Model(AdapterBase):
     """
     Model for Motor, a tornado mongodb driver,
     based on pymongo
+
+    Query result should be looped by 'async for', ex.
+
+        async for u in User.find(User.age > 19, batch_size=500):
+            ...
+
+    Indexes are created in background, the first query or write
+    waits for them, and raises when any of them failed.
     """
 
     __toresdo_db_conn__ = "localhost", 27017
+    __toresdo_stmt_cache_size__ = 128
 
     def _init_obj(self):
         self._local_model = self.__class__._model.copy()
+        # name set of loaded fields, None means all
+        self._loaded = None
+        # names of fields changed since loaded, None for new models
+        self._dirty = None
 
     @classmethod 
     def _init_cls(klass, fields):
@@ -34,6 +55,10 @@ class Model(AdapterBase):
         else:
             raise Exception("Motor is not initialized.")
 
+        # indexes are created in background, waited by __wait_indexes.
+        klass._index_futures = [klass._db_coll.create_index([(k, 1) for k in names], unique=unique)
+                                for names, unique in klass._index_list(fields)]
+
         # '_id' is builtin primary-key in mongodb
         func = lambda x: ObjectId
         func.__name__ = "_id"
@@ -45,12 +70,32 @@ class Model(AdapterBase):
     def _is_cls_inited(klass):
         return hasattr(klass, "_model") and klass._model != None
 
+    @classmethod
+    def _new_row(klass, raw, fields=None):
+        m = klass()
+        m._attach_model(raw)
+        m._dirty = set()
+        if fields != None:
+            # '_id' is always returned by mongodb
+            m._loaded = set(fields)
+            m._loaded.add("_id")
+        return m
+
+    def _attach_model(self, model):
+        self._local_model = model
+
     def _set_field(self, name, v):
+        if self._loaded != None and name not in self._loaded:
+            raise FieldNotLoaded(self.__class__, name)
         self._local_model[name] = v
+        if self._dirty != None:
+            self._dirty.add(name)
 
     def _get_field(self, name):
         if name in self._local_model:
             return self._local_model[name]
+        if self._loaded != None and name not in self._loaded:
+            raise FieldNotLoaded(self.__class__, name)
         # this means this field is not set and no default value
         return None
 
@@ -97,12 +142,21 @@ class Model(AdapterBase):
             rec = {"$gt": v2}
         elif op == Cond.ge:
             rec = {"$gte": v2}
+        elif op == Cond.in_:
+            rec = {"$in": list(v2) if type(v2) is tuple else v2}
+        elif op == Cond.not_in:
+            rec = {"$nin": list(v2) if type(v2) is tuple else v2}
+        elif op == Cond.between:
+            rec = {"$gte": v2[0], "$lte": v2[1]}
 
         model_ctx[-1].buf.append({fld._name: rec})
         return model_ctx
 
     @classmethod
-    def _finish_cond(klass, model_ctx):
+    def _finish_cond(klass, model_ctx, opt):
+        if len(model_ctx[-1].buf) == 0:
+            # no condition, match everything
+            return {}
         if len(model_ctx[-1].buf) == 1:
             return model_ctx[-1].buf[0]
         
@@ -110,19 +164,318 @@ class Model(AdapterBase):
         return model_ctx[-1].q
 
     @classmethod
-    def _pre_loop(klass, stmt):
-        pass
+    def _copy_rows(klass, rows):
+        # documents are modified in place through models
+        return [dict(r) for r in rows]
+
+    @classmethod
+    def _bind_cond(klass, tmpl, values):
+        """
+        copy the cached query-BSON, and replace
+        each Cond._Slot with its value.
+        """
+        if type(tmpl) is Cond._Slot:
+            v = values[tmpl._idx]
+            # long value list of $in is bound as a tuple
+            return list(v) if type(v) is tuple else v
+        elif type(tmpl) is dict:
+            return {k: klass._bind_cond(v, values) for k, v in tmpl.items()}
+        elif type(tmpl) is list:
+            return [klass._bind_cond(v, values) for v in tmpl]
+        return tmpl
+
+    @classmethod
+    def _stmt_label(klass, stmt):
+        # values are replaced, only operators and names are kept
+        if type(stmt) is dict:
+            return "{" + ", ".join("{0}: {1}".format(k, klass._stmt_label(v)) for k, v in sorted(stmt.items())) + "}"
+        if type(stmt) is list:
+            return "[" + ", ".join(klass._stmt_label(v) for v in stmt) + "]"
+        return "?"
+
+    @classmethod
+    async def __run(klass, aw, kind="execute", rows=None, label=None):
+        """
+        await 'aw', and emit an event when listened.
+        """
+        if not klass._n_listener:
+            return await aw
+
+        start = time.perf_counter()
+        try:
+            return await aw
+        finally:
+            klass._emit(kind, time.perf_counter() - start, rows, label)
+
+    @classmethod
+    async def __wait_indexes(klass):
+        """
+        wait for indexes created by _init_cls on first use, failures
+        are raised once, ex. a unique index over duplicated values.
+        """
+        futures = klass.__dict__.get("_index_futures")
+        if futures:
+            klass._index_futures = []
+            await asyncio.gather(*futures)
+
+    @classmethod
+    async def _pre_loop_async(klass, stmt, opt):
+        await klass.__wait_indexes()
+        return klass._pre_loop(stmt, opt)
+
+    @classmethod
+    def _pre_loop(klass, stmt, opt):
+        proj = None
+        if "fields" in opt:
+            proj = {k: 1 for k in opt["fields"]}
+        cursor = klass._db_coll.find(stmt, proj)
+        if "order_by" in opt:
+            cursor = cursor.sort(list(opt["order_by"]))
+        if "limit" in opt:
+            cursor = cursor.limit(opt["limit"])
+        if "offset" in opt:
+            cursor = cursor.skip(opt["offset"])
+        return cursor
+
+    @classmethod
+    def _set_batch_size(klass, cursor, size):
+        cursor.batch_size(size)
     
     @classmethod
     def _next_elm(klass, ctx):
-        pass
+        raise Exception("Query result of motor should be looped by 'async for'.")
+
+    @classmethod
+    async def _next_batch_async(klass, cursor, size):
+        return await cursor.to_list(length=size)
     
     @classmethod
-    def _post_loop(klass, ctx):
-        pass
+    def _post_loop(klass, cursor):
+        # cursor might be left open when looping is stopped early.
+        res = cursor.close()
+        if inspect.isawaitable(res):
+            asyncio.ensure_future(res)
 
     """
     Exported Functions
     """
-    def save(self, callback=None):
-        self.__class__._db_coll.insert(self._local_model, callback=callback)
+    async def save(self):
+        """
+        insert this model by 'insert_one'. For a model loaded from
+        database, or already saved, only fields changed since then
+        are written by $set with 'update_one', and nothing is sent
+        when unchanged.
+        """
+        klass = self.__class__
+        await klass.__wait_indexes()
+        if self._dirty != None:
+            return await self.__update_dirty()
+
+        if self._loaded != None:
+            raise Exception("Unable to insert a partially loaded {0}.".format(klass.__name__))
+        # later saves only write changes, including those made
+        # before this insert is done, which need '_id' by then.
+        if "_id" not in self._local_model:
+            self._local_model["_id"] = ObjectId()
+        self._dirty = set()
+
+        klass._touch()
+        try:
+            await klass.__run(klass._db_coll.insert_one(self._local_model), "save", 1)
+        except Exception:
+            # insert it again by next save
+            self._dirty = None
+            raise
+        finally:
+            klass._touch()
+
+    async def __update_dirty(self):
+        klass = self.__class__
+        if len(self._dirty) == 0:
+            return
+        if "_id" in self._dirty:
+            raise Exception("Unable to change primary-key of a saved {0}.".format(klass.__name__))
+
+        dirty, self._dirty = self._dirty, set()
+        doc = {"$set": {k: self._local_model.get(k) for k in dirty}}
+        klass._touch()
+        try:
+            await klass.__run(klass._db_coll.update_one({"_id": self._local_model["_id"]}, doc), "save", 1)
+        except Exception:
+            # keep them for next save
+            self._dirty |= dirty
+            raise
+        finally:
+            klass._touch()
+
+    @classmethod
+    async def update(klass, cond, **changes):
+        """
+        $set fields of all documents matching 'cond' by one
+        'update_many', return count of modified documents.
+        """
+        klass._prepare()
+        await klass.__wait_indexes()
+        doc = {"$set": dict(klass._changes(changes))}
+        stmt = Cond.to_cmd(klass, cond)
+        try:
+            res = await klass.__run(klass._db_coll.update_many(stmt, doc), label=klass.__label(stmt))
+        finally:
+            klass._touch()
+        return res.modified_count
+
+    @classmethod
+    async def delete(klass, cond):
+        """
+        delete all documents matching 'cond' by one 'delete_many',
+        None for all documents. Return count of deleted documents.
+        """
+        klass._prepare()
+        await klass.__wait_indexes()
+        stmt = Cond.to_cmd(klass, cond)
+        try:
+            res = await klass.__run(klass._db_coll.delete_many(stmt), label=klass.__label(stmt))
+        finally:
+            klass._touch()
+        return res.deleted_count
+
+    @classmethod
+    async def count(klass, cond=None):
+        """
+        count documents matching 'cond' by 'count_documents'.
+        """
+        klass._prepare()
+        await klass.__wait_indexes()
+        stmt = Cond.to_cmd(klass, cond)
+        return await klass.__run(klass._db_coll.count_documents(stmt), label=klass.__label(stmt))
+
+    @classmethod
+    async def exists(klass, cond=None):
+        """
+        check if any document matches 'cond', only '_id' is fetched.
+        """
+        klass._prepare()
+        await klass.__wait_indexes()
+        stmt = Cond.to_cmd(klass, cond)
+        return await klass.__run(klass._db_coll.find_one(stmt, {"_id": 1}), label=klass.__label(stmt)) != None
+
+    @classmethod
+    async def save_many(klass, objs, ordered=False):
+        """
+        insert models with batched 'insert_many' calls.
+
+        Return a dict with count of inserted documents and
+        a list of (model, error message) for failed ones.
+        """
+        objs = list(objs)
+        for o in objs:
+            klass.__check_obj(o)
+        if len(objs) == 0:
+            return klass.__bulk_result(0, 0, 0, [])
+        await klass.__wait_indexes()
+
+        try:
+            res = await klass.__run(klass._db_coll.insert_many([o._local_model for o in objs], ordered=ordered),
+                                    "save", len(objs))
+        except BulkWriteError as e:
+            klass.__mark_saved(objs, e, ordered)
+            return klass.__bulk_error(objs, e)
+        finally:
+            klass._touch()
+        klass.__mark_saved(objs)
+        return klass.__bulk_result(len(res.inserted_ids), 0, 0, [])
+
+    @classmethod
+    async def bulk_write(klass, inserts=(), updates=(), upserts=(), key=None, ordered=False):
+        """
+        group inserts, updates and upserts of models into
+        batched 'bulk_write' calls.
+
+        'key' is a list of fields to identify a document for
+        updates and upserts, '_id' by default. Updates only $set
+        fields of models, and upserts replace whole documents.
+
+        Return a dict with counts and a list of (model, error
+        message) for failed ones.
+        """
+        key = [f._name for f in key] if key else ["_id"]
+        objs = []
+        reqs = []
+        for o in inserts:
+            klass.__check_obj(o)
+            objs.append(o)
+            reqs.append(InsertOne(o._local_model))
+        for o in updates:
+            objs.append(o)
+            # '_id' is immutable
+            doc = {k: v for k, v in o._local_model.items() if k not in key and k != "_id"}
+            reqs.append(UpdateOne(klass.__key_of(o, key), {"$set": doc}))
+        for o in upserts:
+            klass.__check_obj(o)
+            objs.append(o)
+            reqs.append(ReplaceOne(klass.__key_of(o, key), o._local_model, upsert=True))
+
+        if len(reqs) == 0:
+            return klass.__bulk_result(0, 0, 0, [])
+        await klass.__wait_indexes()
+
+        try:
+            res = await klass.__run(klass._db_coll.bulk_write(reqs, ordered=ordered), "save", len(reqs))
+        except BulkWriteError as e:
+            klass.__mark_saved(objs, e, ordered)
+            return klass.__bulk_error(objs, e)
+        finally:
+            klass._touch()
+        klass.__mark_saved(objs)
+        return klass.__bulk_result(res.inserted_count, res.modified_count, res.upserted_count, [])
+
+    @classmethod
+    def __label(klass, stmt):
+        return klass._stmt_label(stmt) if klass._n_listener else None
+
+    @classmethod
+    def __check_obj(klass, o):
+        if not isinstance(o, klass):
+            raise TypeError("Save {0} with {1}.".format(type(o).__name__, klass.__name__))
+        if o._loaded != None:
+            raise Exception("Unable to insert a partially loaded {0}.".format(klass.__name__))
+
+    @classmethod
+    def __key_of(klass, o, key):
+        q = {}
+        for k in key:
+            if k not in o._local_model:
+                raise Exception("Key {0} is not set for {1}.".format(k, klass.__name__))
+            q[k] = o._local_model[k]
+        return q
+
+    @classmethod
+    def __mark_saved(klass, objs, e=None, ordered=False):
+        """
+        mark written models, later saves only $set changes.
+
+        Models failed in BulkWriteError 'e' are skipped, and those
+        after the first failed one are never written when ordered.
+        Upserted ones without '_id' are left untouched.
+        """
+        failed = set(err["index"] for err in e.details.get("writeErrors", [])) if e != None else set()
+        for i, o in enumerate(objs):
+            if i in failed:
+                if ordered:
+                    break
+                continue
+            if "_id" in o._local_model:
+                o._dirty = set()
+
+    @classmethod
+    def __bulk_result(klass, inserted, modified, upserted, errors):
+        return {"inserted": inserted, "modified": modified, "upserted": upserted, "errors": errors}
+
+    @classmethod
+    def __bulk_error(klass, objs, e):
+        """
+        map write errors back to models by their index in the request
+        """
+        d = e.details
+        errors = [(objs[err["index"]], err.get("errmsg")) for err in d.get("writeErrors", [])]
+        return klass.__bulk_result(d.get("nInserted", 0), d.get("nModified", 0), d.get("nUpserted", 0), errors)
@@ -8,8 +8,204 @@ Created on Aug 29, 2013
 from __future__ import absolute_import
 
 import sqlite3
+import itertools
+import threading
+import functools
+import types
+import collections
+import json
+import time
 from toresdo.dal import AdapterBase
 from toresdo.dal import Cond
+from toresdo.dal import FieldNotLoaded
+from toresdo.dal import ConnPool
+from toresdo.dal import DefaultConnPool
+from toresdo.dal import AsyncConnPool
+
+
+class ReadWritePool(DefaultConnPool):
+    """
+    Connection pool with one writer and at most 'max_size'
+    read-only readers.
+
+    Writes are serialized on the only writer connection. Readers
+    are handed out by 'req' and 'req_read', and on-disk databases are
+    switched to WAL, so reads never wait behind writes.
+
+    'thread_safe' is enabled by default only when a model sharing
+    the pool sets __toresdo_offload__, and its workers then wait up
+    to 'timeout' seconds (5 by default) for a busy connection.
+    Otherwise the pool is lock-free, and requests fail with
+    OverflowError at once rather than blocking the IOLoop.
+
+    ':memory:' is opened as a shared-cache in-memory database by
+    Model._new_conn_pool_ctx, so readers see what the writer
+    writes. Tables are locked between connections there, writing
+    a table fails with 'database table is locked' while a loop
+    over it is open. Pass 'read_uncommitted'
+    in __toresdo_db_conn__ to let readers skip those locks, at the
+    cost of seeing rows not committed yet. Connections could be used
+    by any thread, one thread at a time.
+    """
+    _writer = 0
+
+    def __init__(self, klass, max_size=4, timeout=None, thread_safe=None):
+        if thread_safe == None:
+            # only offloaded workers share connections among threads
+            thread_safe = klass.__toresdo_offload__ > 0
+        if timeout == None and thread_safe:
+            timeout = 5.0
+
+        # one more slot for the writer
+        super(ReadWritePool, self).__init__(klass, max_size + 1, timeout, thread_safe)
+
+        ctx = self._ctx
+        ctx["check_same_thread"] = False
+        if not ctx.get("uri"):
+            ctx.setdefault("journal_mode", "WAL")
+
+        # journal mode is persistent, and can't be changed by readers
+        self._read_ctx = {k: v for k, v in ctx.items() if k != "journal_mode"}
+        self._read_ctx["query_only"] = 1
+
+        # the writer is created first, and always in the first slot.
+        self._buf.append([klass._new_conn(ctx), ConnPool._aval])
+
+    def _share(self, klass):
+        # connections are used by workers of this model from now on,
+        # none of them is running yet.
+        if klass.__toresdo_offload__ > 0 and self._lock == None:
+            self._lock = threading.Condition()
+            if self._timeout == None:
+                self._timeout = 5.0
+
+    def _alloc(self):
+        return self._producer._new_conn(self._read_ctx)
+
+    def _take_writer(self):
+        if self._buf[ReadWritePool._writer][ConnPool._idx_status] == ConnPool._busy:
+            return None
+
+        self._buf[ReadWritePool._writer][ConnPool._idx_status] = ConnPool._busy
+        return ReadWritePool._writer
+
+    def _give_back(self, key):
+        if key != ReadWritePool._writer:
+            super(ReadWritePool, self)._give_back(key)
+        elif self._buf[key][ConnPool._idx_status] == ConnPool._aval:
+            raise RuntimeError("Give back an available connection, maybe you release it twice.")
+        else:
+            self._buf[key][ConnPool._idx_status] = ConnPool._aval
+
+        if self._lock != None and self._n_waiter > 0:
+            # readers and the writer are waited on the same lock
+            self._lock.notify_all()
+
+    def req_write(self, timeout=None):
+        if self._lock == None:
+            return self._find_one(take=self._take_writer)
+
+        with self._lock:
+            return self._find_one(timeout, self._take_writer)
+
+    @property
+    def in_use(self):
+        return len(self._buf) - self.idle
+
+    @property
+    def idle(self):
+        writer_idle = self._buf[ReadWritePool._writer][ConnPool._idx_status] == ConnPool._aval
+        return len(self._free) + (1 if writer_idle else 0)
+
+
+class _RowType(type):
+    """
+    metaclass of row classes, class attributes not found
+    are read from the model.
+    """
+    def __getattr__(cls, name):
+        row_of = cls.__dict__.get("_row_of")
+        if row_of == None:
+            raise AttributeError(name)
+        return getattr(row_of, name)
+
+
+class _Row(object, metaclass=_RowType):
+    """
+    base of row classes generated by Model.__new_row_cls.
+
+    Model classes always carry a __dict__, so row classes are
+    not their subclasses. Descriptors of the model (methods,
+    property, classmethod...) are copied into row classes, other
+    attributes are read from the model, and __class__ is the model,
+    which makes isinstance and super() work as they do with models.
+
+    Rows are created without calling __init__, and type(row) is
+    not the model. Models defining their own __init__, or
+    descriptors relying on __dict__ (ex. functools.cached_property),
+    get plain instances of the model instead, see Model._new_row.
+    """
+    __slots__ = ()
+
+    # never read from the model
+    _own = frozenset(["__dict__", "__weakref__"])
+
+    # descriptors not working without __dict__ of the model
+    _unsupported = (functools.cached_property, types.MemberDescriptorType, types.GetSetDescriptorType)
+
+    @property
+    def __class__(self):
+        return type(self)._row_of
+
+    def __getattr__(self, name):
+        cls = type(self)
+        if name in cls.__dict__ and name not in cls.__slots__:
+            # raised by its own property, ex. FieldNotLoaded
+            return cls.__dict__[name].__get__(self, cls)
+        if name in _Row._own:
+            raise AttributeError(name)
+        return getattr(cls._row_of, name)
+
+
+class SlowQuery(object):
+    """
+    A statement over __toresdo_slow_query__, with its plan
+    from 'EXPLAIN QUERY PLAN'.
+
+    'plan' is a list of details of each step, ex.
+    'SEARCH User USING INDEX ix_User_name (name=?)', None when
+    explaining failed. 'scans' are tables scanned without index.
+    """
+    __slots__ = ("sql", "params", "duration", "plan", "scans", "when")
+
+    def __init__(self, sql, params, duration, plan, when):
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.plan = plan
+        self.scans = SlowQuery._scans(plan or [])
+        self.when = when
+
+    @staticmethod
+    def _scans(plan):
+        """
+        'SCAN User' or 'SCAN TABLE User' for older sqlite. Scans
+        through an index, of subqueries and virtual tables (json_each
+        for long IN lists) are not counted.
+        """
+        res = []
+        for detail in plan:
+            words = detail.split()
+            if len(words) < 2 or words[0] != "SCAN" or "USING" in words or "VIRTUAL" in words:
+                continue
+            name = words[2] if words[1] == "TABLE" and len(words) > 2 else words[1]
+            if name in ("CONSTANT", "SUBQUERY"):
+                continue
+            res.append(name)
+        return res
+
+    def __repr__(self):
+        return "<SlowQuery {0:.6f}s {1}>".format(self.duration, self.sql)
 
 
 class Model(AdapterBase):
@@ -24,17 +220,53 @@ class Model(AdapterBase):
     We need to pass values as a iterable(list, tuple), and that's
     how we store the data.
         
-    This sqlite adapter is just implemented for testing, that's why
-    we connect to ':memory:' by default.
+    We connect to ':memory:' by default, set __toresdo_db_conn__
+    to a path for on-disk databases. Connections are pooled by
+    ReadWritePool: queries run on read-only connections, and writes
+    are serialized on one writer connection.
+
+    Set __toresdo_offload__ to run find, find_one and save on
+    worker threads, which return futures and never block the
+    IOLoop. Workers share connections of ReadWritePool, which are
+    used by one thread at a time.
+
+    Besides a path, __toresdo_db_conn__ could be a dict with
+    options applied to every pooled connection:
+
+        __toresdo_db_conn__ = {"path": "app.db", "profile": "throughput", "cache_size": -8000}
+
+    Keys other than 'path' and 'profile' are PRAGMAs in
+    Model._pragmas, and 'cached_statements' passed to
+    sqlite3.connect. 'profile' is a preset in Model._profiles,
+    options provided along with it take precedence.
+
+    Set __toresdo_slow_query__ to a threshold in seconds to log
+    queries slower than that, with plans from 'EXPLAIN QUERY PLAN'.
+    For find, time spent on fetching rows is counted, and the query
+    is checked when its session is closed.
+    The latest __toresdo_slow_query_log_size__ of them are kept,
+    read them by Model.slow_queries().
     """
 
     __toresdo_db_conn__ = ":memory:"
+    __toresdo_stmt_cache_size__ = 128
+    __conn_pool_cls__ = ReadWritePool
+    __toresdo_slow_query__ = None
+    __toresdo_slow_query_log_size__ = 100
+
+    # True for rows loaded with projection
+    _partial = False
+
+    # names of fields changed since loaded, None for new models
+    _dirty = None
 
     def _init_obj(self):
         self._local_val = list(self.__class__._field_default)
 
     @classmethod
     def _init_cls(klass, fields):
+        indexes = klass._index_list(fields)
+
         # init all required variables
         klass._sql_cmd = {}
         klass._field_idx = {}
@@ -51,6 +283,11 @@ class Model(AdapterBase):
 
         # convert it into tuple
         klass._field_default = tuple(field_default)
+        klass._field_names = tuple(fields.keys())
+
+        # prepare light-weight class for fetched rows
+        klass._row_cls = klass.__new_row_cls()
+        klass._proj_row_cls = {}
 
         # prepare create-table command
         cmd = "CREATE TABLE IF NOT EXISTS " + klass.__name__ + " ("
@@ -62,9 +299,19 @@ class Model(AdapterBase):
                 cmd += " INTEGER"
             elif v._type is str:
                 cmd += " TEXT"
+            if v._pk:
+                cmd += " PRIMARY KEY"
         cmd += ")"
         klass._sql_cmd["create_table"] = cmd
-        
+
+        # prepare create-index commands
+        klass._sql_cmd["create_index"] = []
+        for names, unique in indexes:
+            cmd = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+            cmd += " IF NOT EXISTS " + ("ux_" if unique else "ix_") + "_".join((klass.__name__,) + names)
+            cmd += " ON " + klass.__name__ + " (" + ", ".join(names) + ")"
+            klass._sql_cmd["create_index"].append(cmd)
+
         # prepare insert command
         cmd = "INSERT INTO " + klass.__name__ + " VALUES ("
         cmd += "?, " * (len(fields) - 1)    # the last qmark need special handle
@@ -73,19 +320,86 @@ class Model(AdapterBase):
         klass._sql_cmd["insert"] = cmd
 
         # create table if not exist
-        idx = klass.__conn_pool__.req()
+        idx = klass.__conn_pool__.req_write()
         if idx != None:
             conn = klass.__conn_pool__[idx]
             with conn:
                 conn.execute(klass._sql_cmd["create_table"])
+                for cmd in klass._sql_cmd["create_index"]:
+                    conn.execute(cmd)
             klass.__conn_pool__.dispose(idx)
             
+    @classmethod
+    def __new_row_cls(klass, loaded=None):
+        """
+        generate a __slots__-based class without __dict__ for
+        rows fetched from database, see _Row.
+
+        The raw tuple from sqlite is wrapped without copy, and
+        only copied when a field is written. Fields are read through
+        property with the index already resolved.
+
+        'loaded' is the name list of a projection, accessing
+        fields not in it would raise FieldNotLoaded.
+
+        The model itself is returned when rows can't skip its
+        __init__ or its descriptors can't be copied.
+        """
+        if klass.__init__ is not AdapterBase.__init__:
+            return klass
+
+        attrs = {}
+        for c in reversed(klass.__mro__[:-1]):
+            for k, v in c.__dict__.items():
+                if k in _Row._own or not hasattr(type(v), "__get__"):
+                    continue
+                if isinstance(v, _Row._unsupported):
+                    return klass
+                attrs[k] = v
+
+        idx = klass._field_idx
+        attrs.update({"__slots__": ("_local_val", "_dirty"), "_row_of": klass, "_field_idx": idx,
+                      "__module__": klass.__module__, "__qualname__": klass.__qualname__})
+        if loaded != None:
+            for k in loaded:
+                if k not in klass._field_idx:
+                    raise Exception("Unknown field {0} of {1}.".format(k, klass.__name__))
+
+            # values are placed in the order of projection
+            idx = {k: i for i, k in enumerate(loaded)}
+            attrs["_field_idx"] = idx
+            attrs["_partial"] = True
+
+        for k in klass._field_idx:
+            if k in idx:
+                attrs[k] = property(lambda self, i=idx[k]: self._local_val[i],
+                                    lambda self, val, f=getattr(klass, k): f.__set__(self, val))
+            else:
+                attrs[k] = property(klass.__not_loaded(k), klass.__not_loaded(k))
+
+        return _RowType(klass.__name__, (_Row,), attrs)
+
+    @classmethod
+    def __not_loaded(klass, name):
+        def fn(self, *args):
+            raise FieldNotLoaded(klass, name)
+        return fn
+
     @classmethod
     def _uninit_cls(klass):
-        if hasattr(klass, "_field_idx"):
+        # row class shares these attributes with its model, never delete them from there.
+        if "_field_idx" in klass.__dict__:
             del klass._field_idx
-        if hasattr(klass, "_field_default"):
+        if "_field_default" in klass.__dict__:
             del klass._field_default
+        if "_field_names" in klass.__dict__:
+            del klass._field_names
+        if "_row_cls" in klass.__dict__:
+            del klass._row_cls
+        if "_proj_row_cls" in klass.__dict__:
+            del klass._proj_row_cls
+        if "__slow_log__" in klass.__dict__:
+            del klass.__slow_log__
 
     @classmethod
     def _is_cls_inited(klass):
@@ -100,11 +414,46 @@ class Model(AdapterBase):
     def _attach_model(self, model):
         self._local_val = model
 
+    @classmethod
+    def _new_row(klass, raw, fields=None):
+        if fields == None:
+            cls = klass._row_cls
+        else:
+            cls = klass._proj_row_cls.get(fields)
+            if cls == None:
+                cls = klass._proj_row_cls[fields] = klass.__new_row_cls(fields)
+
+        if cls is klass:
+            # a plain model, index of projected fields is kept on it
+            row = klass()
+            row._local_val = raw
+            if fields != None:
+                row._field_idx = {k: i for i, k in enumerate(fields)}
+                row._partial = True
+            return row
+
+        row = object.__new__(cls)
+        row._local_val = raw
+        return row
+
     def _set_field(self, name, v):
-        self._local_val[self.__class__._field_idx[name]] = v
+        try:
+            idx = self._field_idx[name]
+        except KeyError:
+            raise FieldNotLoaded(self.__class__, name)
+        if type(self._local_val) is tuple:
+            # copy on first write, and start tracking changes
+            self._local_val = list(self._local_val)
+            self._dirty = set()
+        self._local_val[idx] = v
+        if self._dirty != None:
+            self._dirty.add(name)
 
     def _get_field(self, name):
-        return self._local_val[self.__class__._field_idx[name]]
+        try:
+            return self._local_val[self._field_idx[name]]
+        except KeyError:
+            raise FieldNotLoaded(self.__class__, name)
 
     @classmethod
     def _init_cond_ctx(klass):
@@ -137,6 +486,9 @@ class Model(AdapterBase):
         stmt[0] = klass.__handle_bool(ctx[Cond.i_idx], ctx[Cond.i_op], stmt[0])
         stmt[0] += fld._name
 
+        if op >= Cond.in_:
+            return klass.__handle_multi(op, v2, stmt)
+
         if op == Cond.lt:
             stmt[0] += "<"
         elif op == Cond.le:
@@ -155,43 +507,251 @@ class Model(AdapterBase):
 
         return stmt
 
+    @classmethod
+    def __handle_multi(klass, op, v2, stmt):
+        if op == Cond.between:
+            stmt[0] += " BETWEEN ? AND ?"
+            stmt[1].extend(v2)
+            return stmt
+
+        stmt[0] += " IN " if op == Cond.in_ else " NOT IN "
+        if type(v2) is tuple and len(v2) <= Cond._max_inline:
+            stmt[0] += "(" + ", ".join("?" * len(v2)) + ")"
+            stmt[1].extend(v2)
+        else:
+            # passed as one JSON array, no matter how many values
+            stmt[0] += "(SELECT value FROM json_each(?))"
+            stmt[1].append(json.dumps(v2) if type(v2) is tuple else v2)
+        return stmt
+
     @classmethod 
-    def _finish_cond(klass, stmt):
-        stmt[0] = "SELECT * FROM " + klass.__name__ + " WHERE " + stmt[0]
+    def _finish_cond(klass, stmt, opt):
+        action = opt.get("action")
+        if action == "update":
+            cmd = "UPDATE " + klass.__name__ + " SET " + ", ".join(k + "=?" for k, _ in opt["set"])
+            # values of SET come before those of WHERE
+            stmt[1] = [v for _, v in opt["set"]] + stmt[1]
+        elif action == "delete":
+            cmd = "DELETE FROM " + klass.__name__
+        elif action == "count":
+            cmd = "SELECT COUNT(*) FROM " + klass.__name__
+        elif action == "exists":
+            cmd = "SELECT 1 FROM " + klass.__name__
+        else:
+            return klass.__finish_select(stmt, opt)
+
+        if len(stmt[0]) > 0:
+            cmd += " WHERE " + stmt[0]
+        if action == "exists":
+            cmd += " LIMIT 1"
+        stmt[0] = cmd
+        return stmt
+
+    @classmethod
+    def __finish_select(klass, stmt, opt):
+        cols = "*"
+        if "fields" in opt:
+            cols = ", ".join(opt["fields"])
+
+        cmd = "SELECT " + cols + " FROM " + klass.__name__
+        if len(stmt[0]) > 0:
+            cmd += " WHERE " + stmt[0]
+
+        if "order_by" in opt:
+            cmd += " ORDER BY " + ", ".join(k + (" ASC" if order == Cond.asc else " DESC")
+                                            for k, order in opt["order_by"])
+
+        # OFFSET is only allowed after LIMIT in sqlite, -1 means no limit.
+        if "limit" in opt:
+            cmd += " LIMIT ?"
+            stmt[1].append(opt["limit"])
+        elif "offset" in opt:
+            cmd += " LIMIT -1"
+        if "offset" in opt:
+            cmd += " OFFSET ?"
+            stmt[1].append(opt["offset"])
+
+        stmt[0] = cmd
         return stmt
     
     @classmethod
-    def _pre_loop(klass, stmt):
-        idx = klass.__conn_pool__.req()
-        if idx != None:
-            curs = klass.__conn_pool__[idx].cursor()
-            curs.execute(stmt[0], stmt[1])
-        else:
+    def _stmt_key(klass, stmt):
+        return (stmt[0], tuple(stmt[1]))
+
+    @classmethod
+    def _stmt_label(klass, stmt):
+        return stmt[0]
+
+    @classmethod
+    def __run(klass, conn, run, sql, params, kind="execute", rows=None, log=True):
+        """
+        call 'run(sql, params)', emit an event when listened, and
+        log statements composed by Cond slower than the threshold.
+
+        'log' is False for queries looped by sessions, which are
+        checked in _post_loop with time spent on fetching included.
+        """
+        threshold = klass.__toresdo_slow_query__ if kind == "execute" and log else None
+        if not klass._n_listener and threshold == None:
+            return run(sql, params)
+
+        start = time.perf_counter()
+        ret = run(sql, params)
+        duration = time.perf_counter() - start
+        if klass._n_listener:
+            klass._emit(kind, duration, rows, sql)
+        if threshold != None and duration >= threshold:
+            klass.__log_slow(conn, sql, params, duration)
+        return ret
+
+    @classmethod
+    def __log_slow(klass, conn, sql, params, duration):
+        try:
+            plan = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            # never fail the query itself
+            plan = None
+        klass.__slow_log().append(SlowQuery(sql, tuple(params), duration, plan, time.time()))
+
+    @classmethod
+    def __slow_log(klass):
+        klass = klass._table_cls()
+        size = klass.__toresdo_slow_query_log_size__
+        log = klass.__dict__.get("__slow_log__")
+        if log == None or log.maxlen != size:
+            # latest ones are kept when resized
+            log = klass.__slow_log__ = collections.deque(log or (), maxlen=size)
+        return log
+
+    @classmethod
+    def slow_queries(klass, clear=False):
+        """
+        get logged SlowQuery of this model, oldest first. Pass
+        'clear' to empty the log after reading.
+        """
+        log = klass.__slow_log()
+        res = list(log)
+        if clear:
+            log.clear()
+        return res
+
+    @classmethod
+    def _bind_cond(klass, tmpl, values):
+        return [tmpl[0], [klass.__bind_value(values[v._idx]) if type(v) is Cond._Slot else v for v in tmpl[1]]]
+
+    @staticmethod
+    def __bind_value(v):
+        # long value list of IN is bound as a JSON array
+        return json.dumps(v) if type(v) is tuple else v
+
+    @classmethod
+    def _pre_loop(klass, stmt, opt):
+        return klass.__open_cursor(klass.__conn_pool__.req_read(), stmt)
+
+    @classmethod
+    async def _pre_loop_async(klass, stmt, opt):
+        pool = klass.__conn_pool__
+        if isinstance(pool, AsyncConnPool):
+            # wait for a connection instead of failing when all are busy
+            return klass.__open_cursor(await pool.acquire(), stmt)
+        return klass._pre_loop(stmt, opt)
+
+    @classmethod
+    def __open_cursor(klass, idx, stmt):
+        if idx == None:
             raise Exception("No db connection available.")
 
-        return [idx, curs]
-    
+        conn = klass.__conn_pool__[idx]
+        try:
+            curs = conn.cursor()
+            if klass.__toresdo_slow_query__ == None:
+                klass.__run(conn, curs.execute, stmt[0], stmt[1])
+                return [idx, curs, None]
+
+            # [sql, params, seconds spent in sqlite], fetching included
+            start = time.perf_counter()
+            klass.__run(conn, curs.execute, stmt[0], stmt[1], log=False)
+            return [idx, curs, [stmt[0], stmt[1], time.perf_counter() - start]]
+        except Exception:
+            klass.__conn_pool__.dispose(idx)
+            raise
+
+    @staticmethod
+    def __timed_fetch(ctx, fetch):
+        if ctx[2] == None:
+            return fetch()
+
+        start = time.perf_counter()
+        try:
+            return fetch()
+        finally:
+            ctx[2][2] += time.perf_counter() - start
+
     @classmethod
     def _next_elm(klass, ctx):
-        return ctx[1].fetchone()
+        return klass.__timed_fetch(ctx, ctx[1].fetchone)
+
+    @classmethod
+    def _next_batch(klass, ctx, size):
+        return klass.__timed_fetch(ctx, ctx[1].fetchmany)
+
+    @classmethod
+    def _set_batch_size(klass, ctx, size):
+        ctx[1].arraysize = size
     
     @classmethod
     def _post_loop(klass, ctx):
-        klass.__conn_pool__.dispose(ctx[0])
+        try:
+            threshold = klass.__toresdo_slow_query__
+            if ctx[2] != None and threshold != None and ctx[2][2] >= threshold:
+                klass.__log_slow(klass.__conn_pool__[ctx[0]], *ctx[2])
+        finally:
+            klass.__conn_pool__.dispose(ctx[0])
 
     @classmethod        
     def _cmp_conn(klass, conn1, conn2):
         return 0 if conn1 == conn2 else 1
 
     _conn_4_memory = None
+    _memory_seq = itertools.count()
+
+    # PRAGMAs applied to each connection, in this order
+    _pragmas = ("journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store",
+                "query_only", "read_uncommitted")
+
+    _profiles = {
+        # WAL without fsync on each commit, a crash could lose
+        # latest transactions but never corrupt the database.
+        "throughput": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+            "cached_statements": 256,
+        },
+        # WAL with fsync on each commit.
+        "durable": {
+            "journal_mode": "WAL",
+            "synchronous": "FULL",
+            "cached_statements": 128,
+        },
+    }
 
     @classmethod
     def _new_conn(klass, ctx):
-        if ctx == ":memory:":
+        path = ctx["path"]
+        if path == ":memory:":
             if klass._conn_4_memory == None:
-                klass._conn_4_memory = sqlite3.connect(ctx)
-            
-        return sqlite3.connect(ctx)
+                klass._conn_4_memory = sqlite3.connect(path)
+
+        kw = {k: ctx[k] for k in ("cached_statements", "uri", "check_same_thread") if k in ctx}
+        conn = sqlite3.connect(path, **kw)
+
+        for k in klass._pragmas:
+            if k in ctx:
+                conn.execute("PRAGMA {0}={1}".format(k, ctx[k]))
+        return conn
 
     @classmethod
     def _del_conn(klass, ctx, conn):
@@ -200,11 +760,44 @@ class Model(AdapterBase):
  
     @classmethod
     def _new_conn_pool_ctx(klass, conn_config):
-        return conn_config
+        """
+        normalize __toresdo_db_conn__ into a dict of options.
+
+        ':memory:' is turned into a shared-cache in-memory database,
+        so all connections of a pool open the same database.
+        """
+        if not isinstance(conn_config, dict):
+            conn_config = {"path": conn_config}
+
+        if "path" not in conn_config:
+            raise Exception("Path is required in __toresdo_db_conn__ of {0}.".format(klass.__name__))
+
+        ctx = {}
+        profile = conn_config.get("profile")
+        if profile != None:
+            if profile not in klass._profiles:
+                raise Exception("Unknown profile: {0}.".format(profile))
+            ctx.update(klass._profiles[profile])
+
+        for k, v in conn_config.items():
+            if k in ("path", "profile"):
+                continue
+            if k != "cached_statements" and k not in klass._pragmas:
+                raise Exception("Unknown option of sqlite connection: {0}.".format(k))
+            # values are formatted into PRAGMA statements
+            if type(v) is not int and not str(v).isalnum():
+                raise Exception("Invalid value of {0}: {1}.".format(k, v))
+            ctx[k] = v
+
+        ctx["path"] = conn_config["path"]
+        if ctx["path"] == ":memory:":
+            ctx["path"] = "file:toresdo_{0}?mode=memory&cache=shared".format(next(Model._memory_seq))
+            ctx["uri"] = True
+        return ctx
 
     @classmethod
     def _del_conn_pool_ctx(klass, ctx):
-        if ctx == ":memory:":
+        if ctx != None and ctx["path"] == ":memory:" and klass._conn_4_memory != None:
             klass._conn_4_memory.close()
             klass._conn_4_memory = None
 
@@ -212,10 +805,257 @@ class Model(AdapterBase):
     Exported Functions
     """
     def save(self, callback=None):
-        idx = self.__conn_pool__.req()
+        """
+        insert this model, return a future when offloaded.
+
+        For a model loaded from database, or already saved, only
+        fields changed since then are written by an UPDATE keyed
+        by its primary-key, and nothing is done when unchanged.
+        Models without primary-key are always inserted.
+        """
+        if self.__toresdo_offload__ > 0:
+            return self._offload(self.__save)
+        self.__save()
+
+    def __save(self):
+        if self._pk_name == None:
+            return self.__insert()
+
+        if type(self._local_val) is tuple:
+            # loaded and never changed
+            return
+        if self._dirty != None:
+            return self.__update_dirty()
+        self.__insert()
+
+    def __update_dirty(self):
+        if len(self._dirty) == 0:
+            return
+        if self._pk_name in self._dirty:
+            raise Exception("Unable to change primary-key of a saved {0}.".format(self.__class__.__name__))
+
+        model = self._table_cls()
+        pk = getattr(model, self._pk_name)
+        pk_val = getattr(self, self._pk_name)
+        if pk_val == None:
+            # ex. inserted by save_many, the id assigned by sqlite is unknown
+            raise Exception("Unable to update {0} without primary-key.".format(model.__name__))
+
+        changes = tuple((k, self._local_val[self._field_idx[k]]) for k in sorted(self._dirty))
+        n = model.__execute_write(Cond.to_cmd(model, Cond(Cond.eq, pk, pk_val),
+                                              {"action": "update", "set": changes}))
+        if n == 0:
+            raise Exception("No {0} with primary-key {1} to update.".format(model.__name__, pk_val))
+        self._dirty = set()
+
+    def __insert(self):
+        if self._partial:
+            raise Exception("Unable to insert a partially loaded {0}.".format(self.__class__.__name__))
+
+        idx = self.__conn_pool__.req_write()
         if idx != None:
             conn = self.__conn_pool__[idx]
+            try:
+                with conn:
+                    curs = self.__run(conn, conn.execute, self.__class__._sql_cmd["insert"], self._local_val, "save", 1)
+            finally:
+                self._touch()
+                self.__conn_pool__.dispose(idx)
+
+            if self._pk_name != None:
+                pk_idx = self._field_idx[self._pk_name]
+                if self._local_val[pk_idx] == None and getattr(self._table_cls(), self._pk_name)._type is int:
+                    # INTEGER PRIMARY KEY is assigned by sqlite
+                    self._local_val[pk_idx] = curs.lastrowid
+                # later saves only write changes
+                self._dirty = set()
+
+    @classmethod
+    def update(klass, cond, **changes):
+        """
+        update fields of all rows matching 'cond' in one statement,
+        return count of updated rows, or a future of it when offloaded.
+
+            User.update(User.age < 18, relation=0)
+
+        Models already loaded are not refreshed.
+        """
+        klass._prepare()
+        stmt = Cond.to_cmd(klass, cond, {"action": "update", "set": klass._changes(changes)})
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(klass.__execute_write, stmt)
+        return klass.__execute_write(stmt)
+
+    @classmethod
+    def delete(klass, cond):
+        """
+        delete all rows matching 'cond' in one statement, None for
+        all rows. Return count of deleted rows, or a future of it
+        when offloaded.
+        """
+        klass._prepare()
+        stmt = Cond.to_cmd(klass, cond, {"action": "delete"})
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(klass.__execute_write, stmt)
+        return klass.__execute_write(stmt)
+
+    @classmethod
+    def count(klass, cond=None):
+        """
+        count rows matching 'cond' by SELECT COUNT(*), or a future
+        of it when offloaded.
+        """
+        klass._prepare()
+        stmt = Cond.to_cmd(klass, cond, {"action": "count"})
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(klass.__execute_read, stmt)
+        return klass.__execute_read(stmt)
+
+    @classmethod
+    def exists(klass, cond=None):
+        """
+        check if any row matches 'cond' without loading it, or a
+        future of it when offloaded.
+        """
+        klass._prepare()
+        stmt = Cond.to_cmd(klass, cond, {"action": "exists"})
+        if klass.__toresdo_offload__ > 0:
+            return klass._offload(klass.__execute_read, stmt, bool)
+        return klass.__execute_read(stmt, bool)
+
+    @classmethod
+    def __execute_read(klass, stmt, conv=None):
+        """
+        run a query returning at most one row, and return
+        the first column of it, None when no row.
+        """
+        idx = klass.__conn_pool__.req_read()
+        if idx == None:
+            raise Exception("No db connection available.")
+
+        try:
+            conn = klass.__conn_pool__[idx]
+            row = klass.__run(conn, conn.execute, stmt[0], stmt[1]).fetchone()
+        finally:
+            klass.__conn_pool__.dispose(idx)
+
+        v = row[0] if row != None else None
+        return conv(v) if conv else v
+
+    @classmethod
+    def __execute_write(klass, stmt):
+        idx = klass.__conn_pool__.req_write()
+        if idx == None:
+            raise Exception("No db connection available.")
+
+        try:
+            conn = klass.__conn_pool__[idx]
             with conn:
-                conn.execute(self.__class__._sql_cmd["insert"], self._local_val)
-            self.__conn_pool__.dispose(idx)
+                return klass.__run(conn, conn.execute, stmt[0], stmt[1]).rowcount
+        finally:
+            klass._touch()
+            klass.__conn_pool__.dispose(idx)
+
+    @classmethod
+    def save_many(klass, objs, chunk_size=1000):
+        """
+        insert a batch of models, return count of inserted rows.
+
+        'objs' could be any iterable, including generator.
+        """
+        return sum(klass.isave_many(objs, chunk_size))
+
+    @classmethod
+    def isave_many(klass, objs, chunk_size=1000):
+        """
+        generator version of save_many.
+
+        Models are inserted through 'executemany', and each chunk of
+        'chunk_size' rows is committed in one transaction. Count of
+        rows committed is yielded after each chunk, the writer is
+        not held in between.
+        """
+        it = iter(objs)
+        return klass.__insert_chunks(iter(lambda: klass.__take_chunk(it, chunk_size), []), True)
+
+    @classmethod
+    def save_rows(klass, rows, chunk_size=1000, trusted=False):
+        """
+        insert raw rows without creating models, return count
+        of inserted rows.
+
+        Each row is a dict keyed by field name, or a tuple whose
+        values are ordered as fields are declared. Rows are validated
+        column by column in each chunk, which runs batch form of
+        validators. Pass 'trusted' to skip validation for data
+        already validated.
+        """
+        return sum(klass.isave_rows(rows, chunk_size, trusted))
+
+    @classmethod
+    def isave_rows(klass, rows, chunk_size=1000, trusted=False):
+        """
+        generator version of save_rows.
+        """
+        klass._prepare()
+        it = iter(rows)
+        return klass.__insert_chunks(iter(lambda: klass.__take_rows(it, chunk_size, trusted), []))
+
+    @classmethod
+    def __insert_chunks(klass, chunks, models=False):
+        """
+        'models' is True when chunks are lists of models, or they are
+        lists of rows.
+        """
+        for chunk in chunks:
+            rows = [o._local_val for o in chunk] if models else chunk
+
+            # the writer is taken per chunk, never held across yields
+            idx = klass.__conn_pool__.req_write()
+            if idx == None:
+                raise Exception("No db connection available.")
+            try:
+                conn = klass.__conn_pool__[idx]
+                with conn:
+                    klass.__run(conn, conn.executemany, klass._sql_cmd["insert"], rows, "save", len(rows))
+            finally:
+                klass._touch()
+                klass.__conn_pool__.dispose(idx)
+
+            if models and klass._pk_name != None:
+                # later saves only write changes
+                for o in chunk:
+                    o._dirty = set()
+            yield len(chunk)
+
+    @classmethod
+    def __take_chunk(klass, it, chunk_size):
+        chunk = []
+        for o in itertools.islice(it, chunk_size):
+            if not isinstance(o, klass):
+                raise TypeError("Save {0} with {1}.".format(type(o).__name__, klass.__name__))
+            if o._partial:
+                raise Exception("Unable to insert a partially loaded {0}.".format(klass.__name__))
+            chunk.append(o)
+        return chunk
+
+    @classmethod
+    def __take_rows(klass, it, chunk_size, trusted):
+        chunk = []
+        by_dict = []
+        by_tuple = []
+        for r in itertools.islice(it, chunk_size):
+            if type(r) is dict:
+                by_dict.append(r)
+                r = tuple(r.get(k, d) for k, d in zip(klass._field_names, klass._field_default))
+            else:
+                if len(r) != len(klass._field_names):
+                    raise Exception("Expect {0} values for {1}, but {2}.".format(
+                                    len(klass._field_names), klass.__name__, len(r)))
+                by_tuple.append(r)
+            chunk.append(r)
 
+        if not trusted:
+            klass._check_rows(by_dict)
+            klass._check_rows(by_tuple, klass._field_names)
+        return chunk
@@ -0,0 +1,30 @@
+'''
+Test cases of the benchmark runner, not benchmarks themselves.
+'''
+
+import unittest
+from toresdo.bench import run
+from toresdo.bench import dal
+
+
+class TestBench(unittest.TestCase):
+
+    def tearDown(self):
+        dal.teardown()
+
+    def test_measure(self):
+        calls = []
+        t = run.measure(lambda: calls.append(1), rounds=2, min_time=0.001)
+        self.assertTrue(t > 0)
+        self.assertTrue(len(calls) > 2)
+
+    def test_run(self):
+        res = run.run(only=["field_get", "cond_to_cmd"], rounds=1, min_time=0.001)
+        self.assertEqual(list(res["results"]), ["field_get[1]", "cond_to_cmd[1]", "cond_to_cmd[10]", "cond_to_cmd[100]"])
+        self.assertIn("sqlite", res)
+
+    def test_compare(self):
+        base = {"results": {"a[1]": 1.0, "b[1]": 1.0, "gone[1]": 1.0}}
+        res = {"results": {"a[1]": 1.1, "b[1]": 1.3, "new[1]": 9.0}}
+        self.assertEqual(run.compare(res, base, 0.2), [("b[1]", 1.0, 1.3)])
+        self.assertEqual(run.compare(res, base, 0.5), [])
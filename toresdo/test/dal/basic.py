@@ -5,9 +5,20 @@ Created on Aug 8, 2013
 '''
 
 import unittest
+import asyncio
+import itertools
+import random
+import threading
+import time
 from toresdo.dal import AdapterBase
+from toresdo.dal import Cond
 from toresdo.dal import field
 from toresdo.dal import ConnPool
+from toresdo.dal import DefaultConnPool
+from toresdo.dal import AsyncConnPool
+from toresdo.dal import LRUCache
+from toresdo.dal import Event
+from toresdo.dal import StatAggregator
 
 
 class Model(AdapterBase):
@@ -81,6 +92,40 @@ class Test1(Model):
         if v > self._max_age:
             raise ValueError("")
 
+class Point(Model):
+
+    @field()
+    def x(self):
+        return 0
+
+    @field()
+    def y(self):
+        return 0
+
+
+def _eval(c, row):
+    """
+    evaluate a condition-tree against a dict
+    """
+    if c._op == Cond.and__:
+        return all(_eval(o, row) for o in c._operand)
+    if c._op == Cond.or__:
+        return any(_eval(o, row) for o in c._operand)
+
+    v, x = row[c._operand[0]._name], c._operand[1]
+    return {
+        Cond.lt: lambda: v < x,
+        Cond.le: lambda: v <= x,
+        Cond.eq: lambda: v == x,
+        Cond.ne: lambda: v != x,
+        Cond.gt: lambda: v > x,
+        Cond.ge: lambda: v >= x,
+        Cond.in_: lambda: v in x,
+        Cond.not_in: lambda: v not in x,
+        Cond.between: lambda: x[0] <= v <= x[1],
+    }[c._op]()
+
+
 class TestDB(unittest.TestCase):
     
     def tearDown(self):
@@ -282,3 +327,296 @@ class TestDB(unittest.TestCase):
         self.assertNotIn(Conn3, MyPool.closed_cls)
         self.assertIn(Conn4, MyPool.closed_cls)
         self.assertNotIn(Conn5, MyPool.closed_cls)
+
+    def test_cond_optimize(self):
+        x, y = Point.x, Point.y
+        and_, or_ = Cond.and__, Cond.or__
+
+        # flatten nested groups, and remove duplicates
+        c = Cond.optimize(Cond.group(and_, x == 1, Cond.group(and_, y == 2, Cond.group(and_, x == 1))))
+        self.assertEqual(c._op, and_)
+        self.assertEqual([(o._op, o._operand[0]._name, o._operand[1]) for o in c._operand],
+                         [(Cond.eq, "x", 1), (Cond.eq, "y", 2)])
+
+        # a group left with one condition is replaced by it
+        c = Cond.optimize(Cond.group(or_, x == 1, x == 1))
+        self.assertEqual((c._op, c._operand[1]), (Cond.eq, 1))
+
+        # bounds are merged
+        c = Cond.optimize(Cond.group(and_, x > 1, x >= 3, x < 9, x < 7, y > 0))
+        self.assertEqual([(o._op, o._operand[1]) for o in c._operand], [(Cond.ge, 3), (Cond.lt, 7), (Cond.gt, 0)])
+        c = Cond.optimize(Cond.group(and_, x >= 1, x <= 9, x >= 3))
+        self.assertEqual((c._op, c._operand[1]), (Cond.between, (3, 9)))
+
+        # or-of-equals is a membership test
+        c = Cond.optimize(Cond.group(or_, x == 1, y == 1, x == 2, x.in_([2, 3])))
+        self.assertEqual([(o._op, o._operand[1]) for o in c._operand], [(Cond.in_, (1, 2, 3)), (Cond.eq, 1)])
+
+        # nothing to do
+        self.assertEqual(Cond.optimize(None), None)
+        leaf = x == 1
+        self.assertIs(Cond.optimize(leaf), leaf)
+
+    def test_cond_optimize_keeps_meaning(self):
+        rnd = random.Random(7)
+        fields = [Point.x, Point.y]
+        ops = [Cond.lt, Cond.le, Cond.eq, Cond.ne, Cond.gt, Cond.ge]
+
+        def leaf():
+            f = rnd.choice(fields)
+            r = rnd.random()
+            if r < 0.1:
+                return f.in_(rnd.sample(range(6), rnd.randint(0, 3)))
+            if r < 0.2:
+                return f.between(rnd.randint(0, 5), rnd.randint(0, 5))
+            return Cond(rnd.choice(ops), f, rnd.randint(0, 5))
+
+        def tree(depth):
+            if depth == 0 or rnd.random() < 0.3:
+                return leaf()
+            return Cond.group(rnd.choice([Cond.and__, Cond.or__]), *[tree(depth - 1) for _ in range(rnd.randint(1, 4))])
+
+        rows = [{"x": a, "y": b} for a, b in itertools.product(range(-1, 7), repeat=2)]
+        for _ in range(500):
+            c = tree(3)
+            o = Cond.optimize(c)
+            for row in rows:
+                self.assertEqual(_eval(c, row), _eval(o, row))
+
+    def test_lru_cache(self):
+        c = LRUCache(max_size=2)
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(c.get("a"), 1)
+
+        # 'b' is the least recently used one
+        c.put("c", 3)
+        self.assertEqual(len(c), 2)
+        self.assertNotIn("b", c)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual((c.hits, c.misses), (2, 1))
+
+    def test_lru_cache_ttl(self):
+        c = LRUCache(max_size=2, ttl=0.01)
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), 1)
+
+        time.sleep(0.02)
+        self.assertEqual(c.get("a"), None)
+        self.assertNotIn("a", c)
+
+    def test_lru_cache_threads(self):
+        c = LRUCache(max_size=8)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(2000):
+                    k = (n + i) % 16
+                    if c.get(k) == None:
+                        c.put(k, i)
+            except Exception as e:
+                errors.append(e)
+
+        ts = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(c), 8)
+        self.assertEqual(c.hits + c.misses, 8 * 2000)
+
+    def test_touch_threads(self):
+        v = Point._data_version()
+
+        def worker():
+            for _ in range(1000):
+                Point._touch()
+
+        ts = [threading.Thread(target=worker) for _ in range(8)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+
+        # no invalidation is lost
+        self.assertEqual(Point._data_version(), v + 8 * 1000)
+
+    def test_stat_aggregator(self):
+        agg = StatAggregator(max_samples=10)
+        for i in range(20):
+            agg(Event("fetch", Point, float(i), rows=2, label="q"))
+        agg(Event("compile", Point, 0.5))
+
+        r = agg.report()
+        # only the latest 10 durations are kept for percentiles
+        self.assertEqual(r[("fetch", "Point", "q")], {"count": 20, "rows": 40, "p50": 15.0, "p99": 19.0})
+        self.assertEqual(r[("compile", "Point", None)]["count"], 1)
+
+        agg.clear()
+        self.assertEqual(agg.report(), {})
+
+    def test_stmt_cache_disabled_by_default(self):
+        self.assertEqual(Model.stmt_cache(), None)
+
+    def test_conn_pool_free_list(self):
+        pool = DefaultConnPool(Model, max_size=2)
+        k1 = pool.req()
+        k2 = pool.req()
+        self.assertNotEqual(k1, k2)
+        self.assertEqual((pool.in_use, pool.idle), (2, 0))
+
+        # no waiting in single-thread mode
+        with self.assertRaises(OverflowError):
+            pool.req()
+
+        pool.dispose(k1)
+        self.assertEqual((pool.in_use, pool.idle), (1, 1))
+        self.assertEqual(pool.req(), k1)
+
+        pool.dispose(k2)
+        with self.assertRaises(RuntimeError):
+            pool.dispose(k2)
+
+        pool.close_all()
+        self.assertEqual((pool.in_use, pool.idle), (0, 0))
+
+    def test_conn_pool_wait(self):
+        pool = DefaultConnPool(Model, max_size=1, timeout=5, thread_safe=True)
+        k = pool.req()
+
+        # a busy connection is given back by another thread
+        waiting = threading.Event()
+        def give_back():
+            waiting.wait()
+            while pool.waiters == 0:
+                time.sleep(0.001)
+            pool.dispose(k)
+        t = threading.Thread(target=give_back)
+        t.start()
+
+        waiting.set()
+        self.assertEqual(pool.req(), k)
+        t.join()
+        self.assertEqual(pool.waiters, 0)
+        self.assertGreater(pool.wait_time, 0)
+
+        # nobody gives back
+        with self.assertRaises(OverflowError):
+            pool.req(timeout=0.01)
+        self.assertEqual(pool.waiters, 0)
+
+        pool.close_all()
+
+    def test_conn_pool_opt(self):
+        class Opt(Model):
+            __toresdo_db_conn__ = "remote_opt"
+            __conn_pool_opt__ = {"max_size": 1}
+
+        Opt()
+        k = Opt.__conn_pool__.req()
+        with self.assertRaises(OverflowError):
+            Opt.__conn_pool__.req()
+        Opt.__conn_pool__.dispose(k)
+
+    def test_async_conn_pool(self):
+        pool = AsyncConnPool(Model, max_size=1)
+        order = []
+
+        async def worker(name):
+            async with pool.connection():
+                order.append(name)
+                # yield while holding the connection
+                await asyncio.sleep(0)
+
+        async def run():
+            await asyncio.gather(*[worker(i) for i in range(5)])
+
+        asyncio.run(run())
+
+        # waiters are served in FIFO order, and everything is given back.
+        self.assertEqual(order, list(range(5)))
+        self.assertEqual((pool.in_use, pool.idle, pool.waiters), (0, 1, 0))
+        pool.close_all()
+
+    def test_async_conn_pool_timeout(self):
+        pool = AsyncConnPool(Model, max_size=1)
+
+        async def run():
+            k = await pool.acquire()
+            # no waiting for synchronous caller
+            with self.assertRaises(OverflowError):
+                pool.req()
+            with self.assertRaises(OverflowError):
+                await pool.acquire(timeout=0.01)
+
+            # the waiter timed out should be skipped
+            pool.dispose(k)
+            self.assertEqual(await pool.acquire(), k)
+            pool.dispose(k)
+
+        asyncio.run(run())
+        self.assertEqual((pool.in_use, pool.waiters), (0, 0))
+        pool.close_all()
+
+    def test_async_conn_pool_as_model_pool(self):
+        class Async(Model):
+            __toresdo_db_conn__ = "remote_async"
+            __conn_pool_cls__ = AsyncConnPool
+
+        Async()
+        self.assertEqual(type(Async.__conn_pool__), AsyncConnPool)
+
+    def test_batch_validator(self):
+        calls = []
+
+        class Batch(Model):
+            @field()
+            def age(self):
+                return 0
+
+            @age.validator
+            def age(self, v):
+                calls.append(("value", v))
+                if v < 0:
+                    raise ValueError()
+
+            @age.batch_validator
+            def age(self, values):
+                calls.append(("column", tuple(values)))
+                if min(values) < 0:
+                    raise ValueError()
+
+            # a validator only in batch form
+            @age.batch_validator
+            def age(self, values):
+                if max(values) > 150:
+                    raise ValueError()
+
+        # single value, per-value form is used
+        b = Batch()
+        b.age = 10
+        self.assertEqual(calls, [("value", 10)])
+        with self.assertRaises(ValueError):
+            b.age = 200
+
+        # a column, batch form is used
+        del calls[:]
+        Batch.age._check_column(None, (1, 2, 3))
+        self.assertEqual(calls, [("column", (1, 2, 3))])
+        with self.assertRaises(ValueError):
+            Batch.age._check_column(None, (1, -1))
+        with self.assertRaises(ValueError):
+            Batch.age._check_column(None, (1, 151))
+        with self.assertRaises(Exception):
+            Batch.age._check_column(None, (1, "2"))
+
+        # rows are checked column by column
+        Batch._check_rows([{"age": 1}, {}, {"age": 2}])
+        with self.assertRaises(ValueError):
+            Batch._check_rows([(1,), (-1,)], ("age",))
+        with self.assertRaises(Exception):
+            Batch._check_rows([{"unknown": 1}])
@@ -9,6 +9,7 @@ import tornado.testing
 from toresdo.dal.mongo.motor import Model
 from toresdo.dal import field
 from toresdo.dal import Cond
+from toresdo.dal import FieldNotLoaded
 
 class User(Model):
     
@@ -60,19 +61,15 @@ class TestDB_motor(tornado.testing.AsyncTestCase):
         t = User()
         self.assertEqual(True, hasattr(t, "_id"))
 
-    def test_with_save(self):
+    @tornado.testing.gen_test(timeout=60)
+    async def test_with_save(self):
         """
         verify 'save' works.
         """
-        def handle_save(result, err):
-            self.assertEqual(err, None)
-            self.stop()
-
         t = User()
         t.age = 19
         t.name = "Roy"
-        t.save(callback=handle_save)
-        self.wait(timeout=60)
+        await t.save()
         
     def test_query_stat(self):
         # A very basic one
@@ -123,4 +120,30 @@ class TestDB_motor(tornado.testing.AsyncTestCase):
                                                  {"name": "Bezos"}
                                                  ]},
                                         {"name": "Qoo"}
-                                        ]})
\ No newline at end of file
+                                        ]})
+
+    def test_stmt_cache(self):
+        cache = User.stmt_cache()
+        cache.clear()
+
+        ctx = Cond.to_cmd(User, Cond.group(Cond.or__, User.name == "Tom", User.age > 19))
+        self.assertEqual(ctx, {"$or": [{"name": "Tom"}, {"age": {"$gt": 19}}]})
+
+        # same shape, cached query-BSON should never be modified by binding
+        ctx = Cond.to_cmd(User, Cond.group(Cond.or__, User.name == "Mary", User.age > 5))
+        self.assertEqual(ctx, {"$or": [{"name": "Mary"}, {"age": {"$gt": 5}}]})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_partially_loaded(self):
+        u = User._new_row({"name": "Tom"}, ("name",))
+        self.assertEqual(u.name, "Tom")
+        with self.assertRaises(FieldNotLoaded):
+            u.age
+        with self.assertRaises(FieldNotLoaded):
+            u.age = 10
+
+    def test_query_without_cond(self):
+        self.assertEqual(Cond.to_cmd(User, None), {})
+        # options are applied on cursor, never in query-BSON
+        self.assertEqual(Cond.to_cmd(User, User.age > 1, {"order_by": (("age", Cond.desc),), "limit": 10}),
+                         {"age": {"$gt": 1}})
@@ -0,0 +1,487 @@
+'''
+Test cases of motor adapter running against an in-process
+stand-in of MongoDB, which need neither motor nor a server.
+'''
+
+import asyncio
+import collections
+import operator
+import unittest
+from unittest import mock
+import pymongo
+import pymongo.errors
+from toresdo.dal.mongo.motor import Model
+from toresdo.dal import Cond
+from toresdo.dal import field
+from toresdo.dal import FieldNotLoaded
+
+"""
+In-process stand-in of MongoDB, only those used by
+Model are provided.
+"""
+_ops = {
+    "$lt": operator.lt,
+    "$lte": operator.le,
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$ne": operator.ne,
+    "$in": lambda v, x: v in x,
+    "$nin": lambda v, x: v not in x,
+}
+
+def _match(doc, q):
+    for k, v in q.items():
+        if k == "$and":
+            if not all(_match(doc, c) for c in v):
+                return False
+        elif k == "$or":
+            if not any(_match(doc, c) for c in v):
+                return False
+        elif type(v) is dict:
+            for op, x in v.items():
+                if not _ops[op](doc.get(k), x):
+                    return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+
+class _FakeCursor(object):
+    def __init__(self, docs, proj):
+        self._docs = docs
+        self._proj = proj
+        self._sort = None
+        self._limit = 0
+        self._skip = 0
+        self._res = None
+        self.batch = None
+        self.closed = False
+
+    def sort(self, keys):
+        self._sort = keys
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def batch_size(self, n):
+        self.batch = n
+        return self
+
+    async def to_list(self, length):
+        if self._res == None:
+            docs = list(self._docs)
+            for k, order in reversed(self._sort or []):
+                docs.sort(key=lambda d: d.get(k), reverse=order < 0)
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            # like a real server, documents are sent as copies
+            docs = [{k: v for k, v in d.items() if not self._proj or k in self._proj or k == "_id"} for d in docs]
+            self._res = docs
+
+        batch, self._res = self._res[:length], self._res[length:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeResult(object):
+    def __init__(self, n, ids):
+        self.inserted_count = n["nInserted"]
+        self.modified_count = n["nModified"]
+        self.upserted_count = n["nUpserted"]
+        self.deleted_count = n.get("nRemoved", 0)
+        self.inserted_ids = ids
+
+
+class _FakeCollection(object):
+    def __init__(self):
+        self.docs = []
+        self.cursors = []
+        self.unique = set()
+        self.n_call = 0
+        self.updates = []
+        self._next_id = 0
+
+    def find(self, q, proj=None):
+        c = _FakeCursor([d for d in self.docs if _match(d, q)], proj)
+        self.cursors.append(c)
+        return c
+
+    async def create_index(self, keys, unique=False):
+        if unique:
+            for k, _ in keys:
+                vals = [d.get(k) for d in self.docs]
+                if len(set(vals)) != len(vals):
+                    raise ValueError("duplicate key: {0}".format(k))
+            self.unique.update(k for k, _ in keys)
+
+    def _insert(self, doc):
+        for k in self.unique:
+            if any(d.get(k) == doc.get(k) for d in self.docs):
+                raise ValueError("duplicate key: {0}".format(k))
+        if "_id" not in doc:
+            self._next_id += 1
+            doc["_id"] = self._next_id
+        self.docs.append(doc)
+
+    async def insert_one(self, doc):
+        self.n_call += 1
+        self._insert(doc)
+
+    async def update_one(self, q, doc):
+        self.n_call += 1
+        self.updates.append((q, doc))
+        for d in self.docs:
+            if _match(d, q):
+                d.update(doc["$set"])
+                break
+
+    async def count_documents(self, q):
+        self.n_call += 1
+        return len([d for d in self.docs if _match(d, q)])
+
+    async def find_one(self, q, proj=None):
+        self.n_call += 1
+        for d in self.docs:
+            if _match(d, q):
+                return {k: v for k, v in d.items() if not proj or k in proj}
+        return None
+
+    async def update_many(self, q, doc):
+        found = [d for d in self.docs if _match(d, q)]
+        for d in found:
+            d.update(doc["$set"])
+        return _FakeResult({"nInserted": 0, "nModified": len(found), "nUpserted": 0}, [])
+
+    async def delete_many(self, q):
+        n = len(self.docs)
+        self.docs = [d for d in self.docs if not _match(d, q)]
+        return _FakeResult({"nInserted": 0, "nModified": 0, "nUpserted": 0, "nRemoved": n - len(self.docs)}, [])
+
+    async def insert_many(self, docs, ordered=True):
+        return await self.bulk_write([pymongo.InsertOne(d) for d in docs], ordered)
+
+    async def bulk_write(self, reqs, ordered=True):
+        self.n_call += 1
+        n = {"nInserted": 0, "nModified": 0, "nUpserted": 0}
+        ids = []
+        errors = []
+        for i, r in enumerate(reqs):
+            try:
+                if type(r) is pymongo.InsertOne:
+                    self._insert(r._doc)
+                    ids.append(r._doc["_id"])
+                    n["nInserted"] += 1
+                    continue
+
+                found = [d for d in self.docs if _match(d, r._filter)]
+                if len(found) > 0:
+                    if type(r) is pymongo.ReplaceOne:
+                        found[0].update(r._doc)
+                    else:
+                        found[0].update(r._doc["$set"])
+                    n["nModified"] += 1
+                elif r._upsert:
+                    self._insert(dict(r._doc))
+                    n["nUpserted"] += 1
+            except ValueError as e:
+                errors.append({"index": i, "errmsg": str(e)})
+                if ordered:
+                    break
+
+        if len(errors) > 0:
+            n["writeErrors"] = errors
+            raise pymongo.errors.BulkWriteError(n)
+        return _FakeResult(n, ids)
+
+
+class _FakeClient(object):
+    def __init__(self):
+        self._coll = collections.defaultdict(_FakeCollection)
+
+    def __getitem__(self, db_name):
+        return self
+
+    def __getattr__(self, coll_name):
+        return self._coll[coll_name]
+
+
+class Fake(Model):
+
+    __toresdo_db_conn__ = _FakeClient()
+    __toresdo_db_name__ = "db"
+
+    @field(unique=True)
+    def name(self):
+        return ""
+
+    @field()
+    def age(self):
+        return 0
+
+
+class TestDB_motor_fake(unittest.TestCase):
+    """
+    test cases run against in-process stand-in of MongoDB
+    """
+    def setUp(self):
+        Fake()
+        Fake._db_coll.docs = [{"_id": i, "name": "u{0}".format(i), "age": i} for i in range(10)]
+        Fake._db_coll._next_id = 10
+        Fake._db_coll.cursors = []
+        Fake._db_coll.n_call = 0
+        Fake._db_coll.updates = []
+
+    def test_async_for(self):
+        async def run():
+            return [u async for u in Fake.find(Fake.age > 1, batch_size=3)]
+
+        users = asyncio.run(run())
+        self.assertEqual([u.name for u in users], ["u{0}".format(i) for i in range(2, 10)])
+
+        cursor = Fake._db_coll.cursors[-1]
+        self.assertEqual(cursor.batch, 3)
+        self.assertTrue(cursor.closed)
+
+    def test_async_for_with_options(self):
+        async def run():
+            s = Fake.find(Fake.age < 8, fields=[Fake.name], order_by=[Fake.age.desc()], limit=5, offset=1)
+            return [u async for u in s]
+
+        users = asyncio.run(run())
+        self.assertEqual([u.name for u in users], ["u6", "u5", "u4", "u3", "u2"])
+        with self.assertRaises(FieldNotLoaded):
+            users[0].age
+
+    def test_async_for_break(self):
+        async def run():
+            s = Fake.find(batch_size=2)
+            async for u in s:
+                break
+            s.close()
+            return u
+
+        self.assertEqual(asyncio.run(run()).name, "u0")
+        self.assertTrue(Fake._db_coll.cursors[-1].closed)
+
+    def test_blocking_for(self):
+        with self.assertRaises(Exception):
+            list(Fake.find())
+
+    def test_result_cache(self):
+        async def run():
+            return [u async for u in Fake.find(Fake.age > 7)]
+
+        Fake.__toresdo_result_cache_size__ = 8
+        try:
+            users = asyncio.run(run())
+            n = len(Fake._db_coll.cursors)
+
+            # modifying fetched models leaves cached documents intact
+            users[0].name = "changed"
+            self.assertEqual([u.name for u in asyncio.run(run())], ["u8", "u9"])
+            self.assertEqual(len(Fake._db_coll.cursors), n)
+
+            # invalidated by writes
+            asyncio.run(Fake.save_many([Fake(name="n10", age=10)]))
+            self.assertEqual([u.name for u in asyncio.run(run())], ["u8", "u9", "n10"])
+            self.assertEqual(len(Fake._db_coll.cursors), n + 1)
+        finally:
+            del Fake.__toresdo_result_cache_size__
+            del Fake.__result_cache__
+
+    def test_dirty_fields(self):
+        async def run():
+            return [u async for u in Fake.find(Fake.age == 3)]
+
+        u = asyncio.run(run())[0]
+        asyncio.run(u.save())
+        self.assertEqual(Fake._db_coll.n_call, 0)
+
+        # only changed fields are sent by $set
+        u.age = 30
+        asyncio.run(u.save())
+        self.assertEqual(Fake._db_coll.updates, [({"_id": u._id}, {"$set": {"age": 30}})])
+        asyncio.run(u.save())
+        self.assertEqual(Fake._db_coll.n_call, 1)
+
+        # a new one is inserted once, and then updated
+        n = Fake(name="new", age=1)
+        asyncio.run(n.save())
+        n.age = 2
+        asyncio.run(n.save())
+        self.assertEqual(Fake._db_coll.n_call, 3)
+        self.assertEqual(Fake._db_coll.updates[-1], ({"_id": n._id}, {"$set": {"age": 2}}))
+        self.assertEqual(len([d for d in Fake._db_coll.docs if d["name"] == "new"]), 1)
+
+    def test_dirty_fields_before_inserted(self):
+        pending = []
+        coll = Fake._db_coll
+
+        async def insert_one(doc):
+            f = asyncio.get_running_loop().create_future()
+            pending.append(f)
+            await f
+            coll._insert(doc)
+
+        async def run():
+            n = Fake(name="new", age=1)
+            first = asyncio.ensure_future(n.save())
+            await asyncio.sleep(0)
+
+            # changed and saved again before the insert is done
+            n.age = 2
+            await n.save()
+            self.assertEqual(len(pending), 1)
+
+            # failed, inserted again by next save
+            pending[0].set_exception(Exception("failed"))
+            with self.assertRaises(Exception):
+                await first
+            second = asyncio.ensure_future(n.save())
+            await asyncio.sleep(0)
+            self.assertEqual(len(pending), 2)
+
+            pending[1].set_result(None)
+            await second
+            return n
+
+        with mock.patch.object(coll, "insert_one", insert_one):
+            n = asyncio.run(run())
+
+        self.assertEqual(coll.updates, [({"_id": n._id}, {"$set": {"age": 2}})])
+        n.age = 3
+        asyncio.run(n.save())
+        self.assertEqual(len([d for d in coll.docs if d["name"] == "new"]), 1)
+        self.assertEqual(coll.docs[-1]["age"], 3)
+
+    def test_dirty_fields_update_failed(self):
+        async def run():
+            return [u async for u in Fake.find(Fake.age == 3)]
+
+        async def update_one(q, doc):
+            raise Exception("failed")
+
+        u = asyncio.run(run())[0]
+        u.age = 30
+        with mock.patch.object(Fake._db_coll, "update_one", update_one):
+            with self.assertRaises(Exception):
+                asyncio.run(u.save())
+
+        # changes are kept for next save
+        asyncio.run(u.save())
+        self.assertEqual(Fake._db_coll.updates, [({"_id": u._id}, {"$set": {"age": 30}})])
+
+    def test_index_failed(self):
+        client = _FakeClient()
+        client.Dup.docs = [{"_id": 1, "name": "a"}, {"_id": 2, "name": "a"}]
+
+        class Dup(Model):
+            __toresdo_db_conn__ = client
+            __toresdo_db_name__ = "db"
+
+            @field(unique=True)
+            def name(self):
+                return ""
+
+        Dup()
+        # raised by the first use, instead of being dropped silently
+        with self.assertRaises(ValueError):
+            asyncio.run(Dup.count())
+        self.assertEqual(asyncio.run(Dup.count()), 2)
+
+    def test_in_between(self):
+        async def run(cond):
+            return sorted([u.age async for u in Fake.find(cond)])
+
+        self.assertEqual(asyncio.run(run(Fake.age.in_([1, 3, 5]))), [1, 3, 5])
+        self.assertEqual(asyncio.run(run(Fake.age.not_in([1, 3, 5]))), [0, 2, 4, 6, 7, 8, 9])
+        self.assertEqual(asyncio.run(run(Fake.age.between(2, 4))), [2, 3, 4])
+
+        # long value list is bound as a whole
+        self.assertEqual(asyncio.run(run(Fake.age.in_(range(5, 1000)))), [5, 6, 7, 8, 9])
+        self.assertEqual(asyncio.run(run(Fake.age.in_(range(8, 1000)))), [8, 9])
+
+        self.assertEqual(Cond.to_cmd(Fake, Fake.age.between(2, 4)), {"age": {"$gte": 2, "$lte": 4}})
+
+    def test_count_exists(self):
+        self.assertEqual(asyncio.run(Fake.count(Fake.age >= 5)), 5)
+        self.assertEqual(asyncio.run(Fake.count()), 10)
+        self.assertTrue(asyncio.run(Fake.exists(Fake.name == "u3")))
+        self.assertFalse(asyncio.run(Fake.exists(Fake.name == "nobody")))
+        self.assertEqual(Fake._db_coll.n_call, 4)
+        self.assertEqual(Fake._db_coll.cursors, [])
+
+    def test_update_delete(self):
+        self.assertEqual(asyncio.run(Fake.update(Fake.age < 3, name="young")), 3)
+        self.assertEqual(sorted(d["name"] for d in Fake._db_coll.docs if d["age"] < 4), ["u3", "young", "young", "young"])
+
+        self.assertEqual(asyncio.run(Fake.delete(Cond.group(Cond.or__, Fake.age == 1, Fake.age == 9))), 2)
+        self.assertEqual(asyncio.run(Fake.delete(None)), 8)
+        self.assertEqual(Fake._db_coll.docs, [])
+
+        with self.assertRaises(Exception):
+            asyncio.run(Fake.update(Fake.age < 3, nickname="young"))
+
+    def test_save_many(self):
+        users = [Fake(name="n{0}".format(i), age=i) for i in range(5)]
+        # duplicated names
+        users.insert(2, Fake(name="u1"))
+        users.append(Fake(name="n0"))
+
+        res = asyncio.run(Fake.save_many(users))
+        self.assertEqual(Fake._db_coll.n_call, 1)
+        self.assertEqual(res["inserted"], 5)
+        self.assertEqual([(o.name, "duplicate key: name") for o in (users[2], users[-1])],
+                         [(o.name, msg) for o, msg in res["errors"]])
+
+        # unordered, documents after failed ones are still written
+        self.assertEqual(len(Fake._db_coll.docs), 15)
+        self.assertNotEqual(users[4]._id, None)
+
+        # saved ones are updated later, failed ones are inserted again
+        users[0].age = 100
+        asyncio.run(users[0].save())
+        self.assertEqual(Fake._db_coll.updates, [({"_id": users[0]._id}, {"$set": {"age": 100}})])
+        users[2].name = "n9"
+        asyncio.run(users[2].save())
+        self.assertEqual(len(Fake._db_coll.docs), 16)
+
+    def test_bulk_write(self):
+        loaded = Fake._new_row(dict(Fake._db_coll.docs[0]))
+        loaded.age = 100
+        upsert_new = Fake(name="new", age=1)
+        upsert_old = Fake(name="u2", age=200)
+
+        res = asyncio.run(Fake.bulk_write(inserts=[Fake(name="ins"), Fake(name="u3")],
+                                          updates=[loaded],
+                                          upserts=[upsert_new, upsert_old],
+                                          key=[Fake.name]))
+        self.assertEqual(Fake._db_coll.n_call, 1)
+        self.assertEqual((res["inserted"], res["modified"], res["upserted"]), (1, 2, 1))
+        self.assertEqual(len(res["errors"]), 1)
+        self.assertEqual(res["errors"][0][0].name, "u3")
+
+        ages = {d["name"]: d["age"] for d in Fake._db_coll.docs}
+        self.assertEqual((ages["u0"], ages["u2"], ages["new"]), (100, 200, 1))
+
+    def test_bulk_write_then_save(self):
+        ins = Fake(name="ins", age=1)
+        asyncio.run(Fake.bulk_write(inserts=[ins]))
+
+        ins.age = 2
+        asyncio.run(ins.save())
+        self.assertEqual(Fake._db_coll.updates, [({"_id": ins._id}, {"$set": {"age": 2}})])
+        self.assertEqual(len([d for d in Fake._db_coll.docs if d["name"] == "ins"]), 1)
+
+    def test_bulk_write_without_key(self):
+        with self.assertRaises(Exception):
+            asyncio.run(Fake.bulk_write(updates=[Fake(name="no id")]))
@@ -5,9 +5,24 @@ Created on Sep 2, 2013
 '''
 
 import unittest
+import asyncio
+import concurrent.futures
+import functools
+import json
+from unittest import mock
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
 from toresdo.dal.sql.sqlite import Model
 from toresdo.dal import field
 from toresdo.dal import Cond
+from toresdo.dal import FieldNotLoaded
+from toresdo.dal import IdentityMap
+from toresdo.dal import StatAggregator
+from toresdo.dal import AsyncConnPool
 
 class User(Model):
     
@@ -31,6 +46,16 @@ class User(Model):
     def address(self):
         return str
 
+class Account(Model):
+
+    @field(pk=True)
+    def uid(self):
+        return int
+
+    @field()
+    def name(self):
+        return ""
+
 class TestDB_sqlite(unittest.TestCase):
     def tearDown(self):
         Model.release()
@@ -119,4 +144,1139 @@ class TestDB_sqlite(unittest.TestCase):
         u = User(name="Tom", email="a@a.com", age=19)
         self.assertEqual(u.name, "Tom")
         self.assertEqual(u.email, "a@a.com")
-        self.assertEqual(u.age, 19)
\ No newline at end of file
+        self.assertEqual(u.age, 19)
+
+    def test_stmt_cache(self):
+        cache = User.stmt_cache()
+        cache.clear()
+
+        stmt = Cond.to_cmd(User, Cond.group(Cond.and__, User.name == "Tom", User.age > 19))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE (name=? AND age>?)")
+        self.assertEqual(stmt[1], ["Tom", 19])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # same shape, different values: only values are re-bound
+        stmt = Cond.to_cmd(User, Cond.group(Cond.and__, User.name == "Mary", User.age > 5))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE (name=? AND age>?)")
+        self.assertEqual(stmt[1], ["Mary", 5])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # different operator means different shape
+        stmt = Cond.to_cmd(User, Cond.group(Cond.and__, User.name == "Mary", User.age < 5))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE (name=? AND age<?)")
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # different arity of group means different shape
+        stmt = Cond.to_cmd(User, Cond.group(Cond.and__, User.name == "Mary", User.age < 5, User.relation == 1))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE (name=? AND age<? AND relation=?)")
+        self.assertEqual(stmt[1], ["Mary", 5, 1])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache), 3)
+
+    def test_stmt_cache_bounded(self):
+        cache = User.stmt_cache()
+        cache.clear()
+        for i in range(cache.max_size + 10):
+            Cond.to_cmd(User, Cond.group(Cond.or__, *([User.age == i] * (i + 1))))
+
+        self.assertEqual(len(cache), cache.max_size)
+        self.assertEqual(cache.misses, cache.max_size + 10)
+
+    def test_save_many(self):
+        users = [User(name="u{0}".format(i), age=i, relation=i % 2) for i in range(25)]
+        self.assertEqual(User.save_many(users, chunk_size=10), 25)
+
+        ages = sorted(u.age for u in User.find(User.age >= 0))
+        self.assertEqual(ages, list(range(25)))
+
+        # generator in, count of each chunk out
+        gen = (User(name="g{0}".format(i), age=100 + i) for i in range(25))
+        self.assertEqual(list(User.isave_many(gen, chunk_size=10)), [10, 10, 5])
+        self.assertEqual(len(list(User.find(User.age >= 100))), 25)
+
+        # nothing to save
+        self.assertEqual(User.save_many([]), 0)
+
+    def test_save_many_with_wrong_model(self):
+        class Other(Model):
+            @field()
+            def name(self):
+                return ""
+
+        with self.assertRaises(TypeError):
+            User.save_many([User(name="Tom"), Other(name="Mary")])
+
+    def test_save_many_with_partial_model(self):
+        User(name="Tom", age=5, relation=1).save()
+        u = User.find_one(User.name == "Tom", fields=[User.age, User.name])
+
+        with self.assertRaises(Exception):
+            User.save_many([User(name="Mary"), u])
+        self.assertEqual([(v.name, v.age) for v in User.find(User.age >= 0)], [("Tom", 5)])
+
+    def test_find_in_batch(self):
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(25))
+
+        s = User.find(User.age >= 0, batch_size=10)
+        names = [next(s).name for _ in range(20)]
+        self.assertEqual(len(names), 20)
+        self.assertEqual(len(s._buf), 10)
+
+        # the last batch is fetched, connection should be released
+        next(s)
+        self.assertEqual(len(s._buf), 5)
+        self.assertEqual(s._ctx, None)
+        self.assertEqual(len(list(s)), 4)
+
+        # exhausted session would not restart the query
+        self.assertEqual(list(s), [])
+
+        # batch size from model
+        User.__toresdo_batch_size__ = 7
+        try:
+            s = User.find(User.age >= 0)
+            next(s)
+            self.assertEqual(len(s._buf), 7)
+            s.close()
+        finally:
+            del User.__toresdo_batch_size__
+
+    def test_result_cache(self):
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(5))
+
+        User.__toresdo_result_cache_size__ = 8
+        try:
+            cache = User.result_cache()
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 2)), [2, 3, 4])
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            # served from cache, without touching the database
+            with mock.patch.object(User, "_pre_loop", side_effect=AssertionError("queried")):
+                self.assertEqual(sorted(u.age for u in User.find(User.age >= 2)), [2, 3, 4])
+            self.assertEqual(cache.hits, 1)
+
+            # different values, different result
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 3)), [3, 4])
+
+            # any write invalidates cached results
+            User(name="u5", age=5).save()
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 2)), [2, 3, 4, 5])
+            User.save_many([User(name="u6", age=6)])
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 2)), [2, 3, 4, 5, 6])
+
+            # writing a fetched row invalidates, too
+            u = User.find_one(User.age == 6)
+            u.age = 7
+            u.save()
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 6)), [6, 7])
+
+            # results not looped completely are not cached
+            cache.clear()
+            s = User.find(User.age >= 0, batch_size=2)
+            next(s)
+            s.close()
+            self.assertEqual(len(cache), 0)
+        finally:
+            del User.__toresdo_result_cache_size__
+            del User.__result_cache__
+
+    def test_result_cache_find_one(self):
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(5))
+
+        User.__toresdo_result_cache_size__ = 8
+        try:
+            cache = User.result_cache()
+            self.assertEqual(User.find_one(User.age == 3).name, "u3")
+            self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 1, 1))
+
+            with mock.patch.object(User, "_pre_loop", side_effect=AssertionError("queried")):
+                self.assertEqual(User.find_one(User.age == 3).name, "u3")
+            self.assertEqual(cache.hits, 1)
+
+            # reaching limit completes a result, too
+            self.assertEqual(len(list(User.find(User.age >= 0, batch_size=2, limit=2))), 2)
+            with mock.patch.object(User, "_pre_loop", side_effect=AssertionError("queried")):
+                self.assertEqual(len(list(User.find(User.age >= 0, batch_size=2, limit=2))), 2)
+        finally:
+            del User.__toresdo_result_cache_size__
+            del User.__result_cache__
+
+    def test_result_cache_ttl(self):
+        User(name="Tom", age=1).save()
+
+        User.__toresdo_result_cache_size__ = 8
+        User.__toresdo_result_cache_ttl__ = 0.01
+        try:
+            cache = User.result_cache()
+            list(User.find(User.age == 1))
+            list(User.find(User.age == 1))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            time.sleep(0.02)
+            list(User.find(User.age == 1))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        finally:
+            del User.__toresdo_result_cache_size__
+            del User.__toresdo_result_cache_ttl__
+            del User.__result_cache__
+
+    def test_identity_map(self):
+        Account.save_many(Account(uid=i, name="a{0}".format(i)) for i in range(5))
+
+        # without identity-map, each row is a new model
+        self.assertIsNot(Account.find_one(Account.uid == 1), Account.find_one(Account.uid == 1))
+
+        with IdentityMap() as m:
+            a1 = Account.find_one(Account.uid == 1)
+            with mock.patch.object(Account, "_pre_loop", side_effect=AssertionError("queried")):
+                self.assertIs(Account.find_one(Account.uid == 1), a1)
+
+            # rows of other queries are deduplicated too
+            accounts = list(Account.find(Account.uid < 3))
+            self.assertIs(accounts[1], a1)
+            self.assertEqual(len(m), 3)
+
+            # partially loaded rows are not put into map
+            names = list(Account.find(Account.uid > 2, fields=[Account.name]))
+            self.assertEqual([a.name for a in names], ["a3", "a4"])
+            self.assertEqual(len(m), 3)
+
+            # a map is not shared with other threads
+            res = []
+            t = threading.Thread(target=lambda: res.append(IdentityMap.current()))
+            t.start()
+            t.join()
+            self.assertEqual(res, [None])
+            self.assertIs(IdentityMap.current(), m)
+
+        self.assertEqual(IdentityMap.current(), None)
+        self.assertEqual(len(m), 0)
+
+    def test_identity_map_offload(self):
+        class Shared(Model):
+            __toresdo_offload__ = 4
+
+            @field(pk=True)
+            def uid(self):
+                return int
+
+            @field()
+            def name(self):
+                return ""
+
+        Shared.save_many(Shared(uid=i, name="s{0}".format(i)) for i in range(3))
+
+        with IdentityMap() as m:
+            # workers share the map of this block
+            fs = [Shared.find_one(Shared.uid == i % 3) for i in range(30)]
+            rows = [f.result() for f in fs]
+            self.assertEqual(len(m), 3)
+            for i, r in enumerate(rows):
+                self.assertIs(r, m.get(Shared, i % 3))
+
+    def test_conn_profile(self):
+        with tempfile.TemporaryDirectory() as d:
+            class Tuned(Model):
+                __toresdo_db_conn__ = {"path": os.path.join(d, "tuned.db"), "profile": "throughput", "cache_size": -1000}
+
+                @field()
+                def name(self):
+                    return ""
+
+            Tuned(name="Tom").save()
+            self.assertEqual(Tuned.find_one(Tuned.name == "Tom").name, "Tom")
+
+            idx = Tuned.__conn_pool__.req()
+            try:
+                conn = Tuned.__conn_pool__[idx]
+                self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                # NORMAL
+                self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+                # option provided along with profile wins
+                self.assertEqual(conn.execute("PRAGMA cache_size").fetchone()[0], -1000)
+                # MEMORY
+                self.assertEqual(conn.execute("PRAGMA temp_store").fetchone()[0], 2)
+            finally:
+                Tuned.__conn_pool__.dispose(idx)
+                Model.release()
+
+    def test_conn_profile_invalid(self):
+        with self.assertRaises(Exception):
+            Model._new_conn_pool_ctx({"path": ":memory:", "profile": "fastest"})
+        with self.assertRaises(Exception):
+            Model._new_conn_pool_ctx({"path": ":memory:", "page_size": 4096})
+        with self.assertRaises(Exception):
+            Model._new_conn_pool_ctx({"path": ":memory:", "journal_mode": "WAL; DROP TABLE User"})
+        with self.assertRaises(Exception):
+            Model._new_conn_pool_ctx({"journal_mode": "WAL"})
+
+        # each ':memory:' pool gets its own shared-cache database
+        ctx = Model._new_conn_pool_ctx(":memory:")
+        self.assertTrue(ctx["path"].startswith("file:toresdo_"))
+        self.assertTrue(ctx["uri"])
+        self.assertNotEqual(Model._new_conn_pool_ctx(":memory:")["path"], ctx["path"])
+
+    def test_read_write_pool(self):
+        with tempfile.TemporaryDirectory() as d:
+            class Disk(Model):
+                __toresdo_db_conn__ = os.path.join(d, "disk.db")
+
+                @field()
+                def name(self):
+                    return ""
+
+            Disk(name="a").save()
+            pool = Disk.__conn_pool__
+            try:
+                w = pool.req_write()
+                try:
+                    pool[w].execute("BEGIN IMMEDIATE")
+                    pool[w].execute("INSERT INTO Disk VALUES ('b')")
+
+                    # reads are not blocked by an ongoing write
+                    self.assertEqual([o.name for o in Disk.find()], ["a"])
+
+                    # writes are serialized
+                    with self.assertRaises(OverflowError):
+                        pool.req_write(timeout=0.01)
+                    pool[w].commit()
+                finally:
+                    pool.dispose(w)
+                self.assertEqual(sorted(o.name for o in Disk.find()), ["a", "b"])
+
+                # readers are read-only
+                r = pool.req_read()
+                try:
+                    with self.assertRaises(sqlite3.OperationalError):
+                        pool[r].execute("INSERT INTO Disk VALUES ('c')")
+                finally:
+                    pool.dispose(r)
+                self.assertEqual(pool.in_use, 0)
+            finally:
+                Model.release()
+
+    def test_read_write_pool_memory(self):
+        User(name="a").save()
+        pool = User.__conn_pool__
+        w = pool.req_write()
+        try:
+            pool[w].execute("BEGIN IMMEDIATE")
+            pool[w].execute("INSERT INTO User (name) VALUES ('b')")
+
+            # rows not committed are never seen by readers
+            try:
+                names = [o.name for o in User.find()]
+            except sqlite3.OperationalError:
+                names = None
+            self.assertNotIn("b", names or [])
+            pool[w].rollback()
+        finally:
+            pool.dispose(w)
+        self.assertEqual([o.name for o in User.find()], ["a"])
+
+    def test_read_write_pool_lock_free(self):
+        User(name="a").save()
+        pool = User.__conn_pool__
+        self.assertEqual(pool._lock, None)
+
+        # busy connections fail at once instead of blocking
+        w = pool.req_write()
+        try:
+            start = time.monotonic()
+            with self.assertRaises(OverflowError):
+                pool.req_write()
+            self.assertLess(time.monotonic() - start, 0.5)
+        finally:
+            pool.dispose(w)
+
+        class Offloaded(Model):
+            __toresdo_offload__ = 2
+
+            @field()
+            def name(self):
+                return ""
+
+        Offloaded(name="a").save().result()
+        self.assertNotEqual(Offloaded.__conn_pool__._lock, None)
+
+    def test_isave_many_releases_writer(self):
+        gen = User.isave_many((User(name="g{0}".format(i)) for i in range(4)), chunk_size=2)
+        self.assertEqual(next(gen), 2)
+
+        # other writes go on while the generator is suspended
+        w = User.__conn_pool__.req_write(timeout=0.01)
+        User.__conn_pool__.dispose(w)
+        User(name="other").save()
+
+        self.assertEqual(list(gen), [2])
+        self.assertEqual(len(list(User.find())), 5)
+
+    def test_read_write_pool_threads(self):
+        with tempfile.TemporaryDirectory() as d:
+            class Disk(Model):
+                __toresdo_db_conn__ = os.path.join(d, "disk.db")
+                # shared by threads other than offloaded workers
+                __conn_pool_opt__ = {"thread_safe": True}
+
+                @field()
+                def name(self):
+                    return ""
+
+                @field()
+                def n(self):
+                    return 0
+
+            Disk(name="init").save()
+            errors = []
+
+            def write(t):
+                try:
+                    for i in range(20):
+                        Disk(name="t{0}".format(t), n=i).save()
+                        list(Disk.find(Disk.name == "init"))
+                except Exception as e:
+                    errors.append(e)
+
+            ts = [threading.Thread(target=write, args=(t,)) for t in range(4)]
+            for t in ts:
+                t.start()
+            for t in ts:
+                t.join()
+
+            try:
+                self.assertEqual(errors, [])
+                self.assertEqual(len(list(Disk.find(Disk.n >= 0))), 81)
+            finally:
+                Model.release()
+
+    def test_async_conn_pool(self):
+        class Pooled(Model):
+            __conn_pool_cls__ = AsyncConnPool
+            __conn_pool_opt__ = {"max_size": 1}
+
+            @field()
+            def age(self):
+                return 0
+
+        Pooled.save_many(Pooled(age=i) for i in range(3))
+        order = []
+
+        async def loop(name):
+            async for p in Pooled.find(Pooled.age >= 0, batch_size=1):
+                order.append((name, p.age))
+                # yield while holding the only connection
+                await asyncio.sleep(0)
+
+        async def run():
+            first = asyncio.ensure_future(loop("a"))
+            await asyncio.sleep(0)
+            # synchronous callers never wait
+            with self.assertRaises(OverflowError):
+                list(Pooled.find())
+
+            # resumed after the first one gives the connection back
+            await asyncio.gather(first, loop("b"))
+            self.assertEqual(Pooled.__conn_pool__.waiters, 0)
+
+        asyncio.run(run())
+        self.assertEqual(order, [("a", 0), ("a", 1), ("a", 2), ("b", 0), ("b", 1), ("b", 2)])
+        self.assertEqual(Pooled.__conn_pool__.in_use, 0)
+
+    def test_async_conn_pool_memory(self):
+        class Pooled2(Model):
+            __conn_pool_cls__ = AsyncConnPool
+            __conn_pool_opt__ = {"max_size": 2}
+
+            @field()
+            def age(self):
+                return 0
+
+        Pooled2.save_many(Pooled2(age=i) for i in range(3))
+
+        async def loop():
+            ages = []
+            async for p in Pooled2.find(Pooled2.age >= 0, batch_size=1):
+                ages.append(p.age)
+                await asyncio.sleep(0)
+            return ages
+
+        async def run():
+            return await asyncio.gather(loop(), loop())
+
+        # both connections open the same database
+        self.assertEqual(asyncio.run(run()), [[0, 1, 2], [0, 1, 2]])
+        self.assertEqual(Pooled2.__conn_pool__.in_use, 0)
+        self.assertEqual(len(Pooled2.__conn_pool__._buf), 2)
+
+    def test_offload(self):
+        User.__toresdo_offload__ = 2
+        try:
+            futs = [User(name="u{0}".format(i), age=i).save() for i in range(10)]
+            for f in futs:
+                f.result()
+
+            self.assertEqual(sorted(u.age for u in User.find(User.age >= 5).result()), [5, 6, 7, 8, 9])
+            self.assertEqual(User.find_one(User.age == 3).result().name, "u3")
+            self.assertEqual(User.find_one(User.age == 100).result(), None)
+
+            # awaitable in coroutines, and run on workers
+            async def run():
+                main = threading.get_ident()
+                ident = await asyncio.get_running_loop().run_in_executor(User.__executor__, threading.get_ident)
+                u = await User.find_one(User.age == 4)
+                return main != ident, u.name
+
+            self.assertEqual(asyncio.run(run()), (True, "u4"))
+        finally:
+            del User.__toresdo_offload__
+
+        Model.release()
+        self.assertNotIn("__executor__", User.__dict__)
+
+    def test_find_one_not_found(self):
+        User(name="Tom", age=1).save()
+        self.assertEqual(User.find_one(User.age == 100), None)
+
+    def test_offload_executor_once(self):
+        User.__toresdo_offload__ = 2
+        try:
+            created = []
+            new_executor = concurrent.futures.ThreadPoolExecutor
+
+            def slow_executor(*args, **kwargs):
+                # widen the window between the check and the creation
+                time.sleep(0.01)
+                created.append(new_executor(*args, **kwargs))
+                return created[-1]
+
+            with mock.patch("concurrent.futures.ThreadPoolExecutor", slow_executor):
+                ts = [threading.Thread(target=User._offload, args=(len, ())) for _ in range(4)]
+                for t in ts:
+                    t.start()
+                for t in ts:
+                    t.join()
+            self.assertEqual(len(created), 1)
+        finally:
+            del User.__toresdo_offload__
+
+    def test_update_delete_clause(self):
+        stmt = Cond.to_cmd(User, User.age < 18, {"action": "update", "set": (("name", "kid"), ("relation", 0))})
+        self.assertEqual(stmt[0], "UPDATE User SET name=?, relation=? WHERE age<?")
+        self.assertEqual(stmt[1], ["kid", 0, 18])
+
+        # values of SET are bound, not part of the cached statement
+        stmt = Cond.to_cmd(User, User.age < 20, {"action": "update", "set": (("name", "teen"), ("relation", 1))})
+        self.assertEqual(stmt[1], ["teen", 1, 20])
+        self.assertEqual(User.stmt_cache().hits, 1)
+
+        stmt = Cond.to_cmd(User, User.age < 18, {"action": "delete"})
+        self.assertEqual(stmt[0], "DELETE FROM User WHERE age<?")
+        stmt = Cond.to_cmd(User, None, {"action": "delete"})
+        self.assertEqual(stmt[0], "DELETE FROM User")
+
+    def test_in_between_clause(self):
+        cache = User.stmt_cache()
+        cache.clear()
+
+        stmt = Cond.to_cmd(User, User.age.in_([1, 2, 3]))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE age IN (?, ?, ?)")
+        self.assertEqual(stmt[1], [1, 2, 3])
+        stmt = Cond.to_cmd(User, User.age.in_([4, 5, 6]))
+        self.assertEqual(stmt[1], [4, 5, 6])
+        self.assertEqual(cache.hits, 1)
+
+        stmt = Cond.to_cmd(User, User.name.not_in(["Tom"]))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE name NOT IN (?)")
+        stmt = Cond.to_cmd(User, Cond.group(Cond.and__, User.age.between(1, 9), User.name == "Tom"))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE (age BETWEEN ? AND ? AND name=?)")
+        self.assertEqual(stmt[1], [1, 9, "Tom"])
+
+        # long lists are passed as one JSON array, and share one statement
+        stmt = Cond.to_cmd(User, User.age.in_(range(100)))
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE age IN (SELECT value FROM json_each(?))")
+        self.assertEqual(json.loads(stmt[1][0]), list(range(100)))
+        n = len(cache)
+        stmt = Cond.to_cmd(User, User.age.in_(range(200)))
+        self.assertEqual(json.loads(stmt[1][0]), list(range(200)))
+        self.assertEqual(len(cache), n)
+
+        with self.assertRaises(Exception):
+            User.age.in_([1, "2"])
+
+    def test_in_between(self):
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(20))
+
+        self.assertEqual(sorted(u.age for u in User.find(User.age.in_([1, 3, 5]))), [1, 3, 5])
+        self.assertEqual(User.count(User.age.not_in(range(5))), 15)
+        self.assertEqual(sorted(u.age for u in User.find(User.age.between(17, 30))), [17, 18, 19])
+        self.assertEqual(User.count(User.age.in_([])), 0)
+
+        # far more values than variables allowed in a statement
+        ids = list(range(10, 100000))
+        self.assertEqual(User.count(User.age.in_(ids)), 10)
+        self.assertEqual(sorted(u.name for u in User.find(User.name.in_("u{0}".format(i) for i in range(15, 50000)))),
+                         ["u15", "u16", "u17", "u18", "u19"])
+        self.assertEqual(User.delete(User.age.not_in(ids)), 10)
+
+    def test_optimize(self):
+        User.save_many(User(name="u{0}".format(i), age=i, relation=i % 3) for i in range(20))
+        c = Cond.group(Cond.and__,
+                       User.age > 2,
+                       Cond.group(Cond.and__, User.age >= 5, User.age <= 15),
+                       User.age <= 12,
+                       Cond.group(Cond.or__, User.relation == 0, User.relation == 1, User.relation == 0))
+        expected = sorted(u.age for u in User.find(c))
+
+        User.__toresdo_optimize__ = True
+        try:
+            stmt = Cond.to_cmd(User, c)
+            self.assertEqual(stmt[0], "SELECT * FROM User WHERE (age BETWEEN ? AND ? AND relation IN (?, ?))")
+            self.assertEqual(stmt[1], [5, 12, 0, 1])
+            self.assertEqual(sorted(u.age for u in User.find(c)), expected)
+        finally:
+            del User.__toresdo_optimize__
+
+    def test_count_exists(self):
+        stmt = Cond.to_cmd(User, User.age > 1, {"action": "count"})
+        self.assertEqual(stmt[0], "SELECT COUNT(*) FROM User WHERE age>?")
+        stmt = Cond.to_cmd(User, User.age > 1, {"action": "exists"})
+        self.assertEqual(stmt[0], "SELECT 1 FROM User WHERE age>? LIMIT 1")
+
+        self.assertEqual(User.count(), 0)
+        self.assertFalse(User.exists())
+
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(10))
+        self.assertEqual(User.count(User.age >= 5), 5)
+        self.assertEqual(User.count(), 10)
+        self.assertTrue(User.exists(User.name == "u3"))
+        self.assertFalse(User.exists(User.name == "nobody"))
+        self.assertEqual(User.__conn_pool__.in_use, 0)
+
+    def test_update_delete(self):
+        User.save_many(User(name="u{0}".format(i), age=i, relation=0) for i in range(10))
+
+        self.assertEqual(User.update(User.age < 5, relation=1), 5)
+        self.assertEqual(sorted(u.age for u in User.find(User.relation == 1)), [0, 1, 2, 3, 4])
+        self.assertEqual(User.update(None, address="x"), 10)
+        self.assertEqual(User.update(User.age > 100, relation=2), 0)
+
+        self.assertEqual(User.delete(User.age >= 8), 2)
+        self.assertEqual(len(list(User.find(User.address == "x"))), 8)
+        self.assertEqual(User.delete(None), 8)
+        self.assertEqual(list(User.find()), [])
+
+        with self.assertRaises(Exception):
+            User.update(User.age < 5, nickname="x")
+        with self.assertRaises(Exception):
+            User.update(User.age < 5, age="x")
+        with self.assertRaises(Exception):
+            User.update(User.age < 5)
+
+    def test_find_fresh_model(self):
+        class Fresh(Model):
+            @field()
+            def name(self):
+                return ""
+
+        # never instantiated before
+        self.assertEqual(Fresh.find_one(Fresh.name == "a"), None)
+
+        class Fresh2(Model):
+            @field()
+            def name(self):
+                return ""
+
+        self.assertEqual(list(Fresh2.find()), [])
+
+    def test_find_one_release_conn(self):
+        User.save_many(User(name="u{0}".format(i), age=i) for i in range(3))
+        for _ in range(10):
+            self.assertEqual(User.find_one(User.age == 1).name, "u1")
+
+    def test_fetched_row(self):
+        User(name="Tom", email="tom@hotmail.com", age=19).save()
+
+        u = User.find_one(User.name == "Tom")
+        self.assertTrue(isinstance(u, User))
+        self.assertEqual(type(u).__name__, "User")
+        self.assertEqual(type(u).__slots__, ("_local_val", "_dirty"))
+
+        # raw row is wrapped without copy
+        self.assertEqual(type(u._local_val), tuple)
+        self.assertEqual(u.email, "tom@hotmail.com")
+
+        # copy on first write, and type-check still works
+        u.age = 20
+        self.assertEqual(type(u._local_val), list)
+        self.assertEqual(u.age, 20)
+        self.assertEqual(u.name, "Tom")
+        with self.assertRaises(Exception):
+            u.age = "20"
+
+        # a fetched row could be saved as a new one
+        u.name = "Tom2"
+        u.save()
+        self.assertEqual(User.find_one(User.name == "Tom2").age, 20)
+
+    def test_fetched_row_memory(self):
+        User(name="Tom", age=19).save()
+        raw = User.__conn_pool__[0].execute("SELECT * FROM User").fetchone()
+        self.assertFalse(hasattr(User.find_one(User.name == "Tom"), "__dict__"))
+
+        def per_row(new):
+            tracemalloc.start()
+            try:
+                rows = [new() for _ in range(1000)]
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            return size / len(rows)
+
+        def with_dict():
+            o = object.__new__(User)
+            o._local_val = raw
+            return o
+
+        self.assertLess(per_row(lambda: User._new_row(raw)), per_row(with_dict))
+
+    def test_fetched_row_methods(self):
+        saved = []
+
+        class Custom(Model):
+            @field()
+            def name(self):
+                return ""
+
+            def greet(self):
+                return "hi " + self.name
+
+            def save(self):
+                saved.append(self.name)
+                super().save()
+
+        Custom(name="a").save()
+        c = Custom.find_one(Custom.name == "a")
+        self.assertTrue(isinstance(c, Custom))
+        self.assertTrue(isinstance(c, Model))
+        self.assertEqual(c.greet(), "hi a")
+        self.assertEqual(c.__class__, Custom)
+
+        c.name = "b"
+        c.save()
+        self.assertEqual(saved, ["a", "b"])
+        self.assertEqual(sorted(o.name for o in Custom.find()), ["a", "b"])
+        with self.assertRaises(AttributeError):
+            c.nothing
+
+    def test_fetched_row_descriptors(self):
+        class Upper(object):
+            def __get__(self, obj, obj_type):
+                return self if obj == None else obj.name.upper()
+
+        class Desc(Model):
+            upper = Upper()
+
+            @field()
+            def name(self):
+                return ""
+
+            @staticmethod
+            def prefix():
+                return "d-"
+
+            @classmethod
+            def kind(klass):
+                return klass.__name__
+
+            def label(self):
+                return self.prefix() + self.kind() + "-" + self.name
+
+        Desc(name="a").save()
+        d = Desc.find_one(Desc.name == "a")
+        self.assertFalse(hasattr(d, "__dict__"))
+        self.assertEqual(d.label(), "d-Desc-a")
+        self.assertEqual(d.upper, "A")
+
+    def test_fetched_row_plain_model(self):
+        inited = []
+
+        class WithInit(Model):
+            @field(pk=True)
+            def uid(self):
+                return int
+
+            @field()
+            def name(self):
+                return ""
+
+            @field()
+            def age(self):
+                return 0
+
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                inited.append(self)
+
+        class WithCached(Model):
+            @field()
+            def name(self):
+                return ""
+
+            @functools.cached_property
+            def upper(self):
+                return self.name.upper()
+
+        WithInit(uid=1, name="a", age=1).save()
+        WithCached(name="b").save()
+        del inited[:]
+
+        # __init__ runs on fetched rows, which are exact instances
+        w = WithInit.find_one(WithInit.name == "a")
+        self.assertIs(type(w), WithInit)
+        self.assertEqual(inited, [w])
+        self.assertEqual((w.name, w.age), ("a", 1))
+        w.age = 2
+        w.save()
+        self.assertEqual(WithInit.find_one(WithInit.name == "a").age, 2)
+
+        c = WithCached.find_one(WithCached.name == "b")
+        self.assertIs(type(c), WithCached)
+        self.assertEqual(c.upper, "B")
+
+        # projection still works on plain models
+        p = WithInit.find_one(WithInit.name == "a", fields=[WithInit.age])
+        self.assertEqual(p.age, 2)
+        with self.assertRaises(FieldNotLoaded):
+            p.name
+        with self.assertRaises(FieldNotLoaded):
+            p.name = "x"
+
+    def test_dirty_fields(self):
+        Account.save_many(Account(uid=i, name="a{0}".format(i)) for i in range(3))
+
+        executed = []
+        with mock.patch.object(Model, "_Model__execute_write", classmethod(lambda klass, stmt: executed.append(stmt))):
+            # unchanged, nothing written
+            a = Account.find_one(Account.uid == 1)
+            a.save()
+            self.assertEqual(executed, [])
+
+            # only changed fields are written, keyed by primary-key
+            a.name = "changed"
+            a.save()
+            self.assertEqual(executed, [["UPDATE Account SET name=? WHERE uid=?", ["changed", 1]]])
+
+            # nothing more after saved
+            a.save()
+            self.assertEqual(len(executed), 1)
+
+        a.name = "b1"
+        a.save()
+        self.assertEqual(sorted(o.name for o in Account.find()), ["a0", "a2", "b1"])
+
+        # a partially loaded one is updated too
+        p = Account.find_one(Account.uid == 2, fields=[Account.uid, Account.name])
+        p.name = "b2"
+        p.save()
+        self.assertEqual(Account.find_one(Account.uid == 2).name, "b2")
+
+        # a new one is inserted once, and then updated
+        n = Account(uid=3, name="a3")
+        n.save()
+        n.name = "b3"
+        n.save()
+        self.assertEqual([o.name for o in Account.find(Account.uid == 3)], ["b3"])
+
+        with self.assertRaises(Exception):
+            n.uid = 4
+            n.save()
+
+    def test_dirty_fields_assigned_pk(self):
+        a = Account(name="a")
+        a.save()
+        self.assertEqual(a.uid, 1)
+
+        a.name = "b"
+        a.save()
+        self.assertEqual([(o.uid, o.name) for o in Account.find()], [(1, "b")])
+
+        # ids assigned in bulk are unknown, never updated silently
+        objs = [Account(name="c")]
+        Account.save_many(objs)
+        objs[0].name = "d"
+        with self.assertRaises(Exception):
+            objs[0].save()
+
+        # the row is gone
+        b = Account.find_one(Account.uid == 1)
+        Account.delete(Account.uid == 1)
+        b.name = "e"
+        with self.assertRaises(Exception):
+            b.save()
+
+    def test_dirty_fields_after_save_many(self):
+        objs = [Account(uid=i, name="a{0}".format(i)) for i in range(3)]
+        Account.save_many(objs, chunk_size=2)
+
+        objs[2].name = "b2"
+        objs[2].save()
+        self.assertEqual(sorted(o.name for o in Account.find()), ["a0", "a1", "b2"])
+
+    def test_find_with_fields(self):
+        User(name="Tom", email="tom@hotmail.com", age=19, relation=1).save()
+
+        stmt = Cond.to_cmd(User, User.age > 1, {"fields": ("name", "age")})
+        self.assertEqual(stmt[0], "SELECT name, age FROM User WHERE age>?")
+
+        u = User.find_one(User.name == "Tom", fields=[User.age, User.name])
+        self.assertEqual(u.name, "Tom")
+        self.assertEqual(u.age, 19)
+        self.assertEqual(len(u._local_val), 2)
+        with self.assertRaises(FieldNotLoaded):
+            u.email
+        with self.assertRaises(FieldNotLoaded):
+            u.email = "a@a.com"
+        with self.assertRaises(Exception):
+            u.save()
+
+        # projected and full rows never mixed up
+        self.assertEqual(User.find_one(User.name == "Tom").email, "tom@hotmail.com")
+        self.assertEqual([v.relation for v in User.find(User.age > 1, fields=[User.relation])], [1])
+
+    def test_order_limit_offset(self):
+        stmt = Cond.to_cmd(User, User.age > 1, {"order_by": (("age", Cond.desc), ("name", Cond.asc)),
+                                                "limit": 10, "offset": 20})
+        self.assertEqual(stmt[0], "SELECT * FROM User WHERE age>? ORDER BY age DESC, name ASC LIMIT ? OFFSET ?")
+        self.assertEqual(stmt[1], [1, 10, 20])
+
+        # limit/offset are bound like values
+        stmt = Cond.to_cmd(User, User.age > 2, {"order_by": (("age", Cond.desc), ("name", Cond.asc)),
+                                                "limit": 5, "offset": 0})
+        self.assertEqual(stmt[1], [2, 5, 0])
+
+        stmt = Cond.to_cmd(User, None, {"offset": 3})
+        self.assertEqual(stmt[0], "SELECT * FROM User LIMIT -1 OFFSET ?")
+        self.assertEqual(stmt[1], [3])
+
+        User.save_many(User(name="u{0}".format(i), age=i % 5) for i in range(20))
+        self.assertEqual(len(list(User.find())), 20)
+
+        users = list(User.find(User.age < 3, order_by=[User.age.desc(), User.name], limit=4, offset=2))
+        self.assertEqual([(u.age, u.name) for u in users],
+                         [(2, "u2"), (2, "u7"), (1, "u1"), (1, "u11")])
+
+        self.assertEqual(User.find_one(order_by=[User.age.desc(), User.name.desc()]).name, "u9")
+
+    def test_seek(self):
+        User.save_many(User(name="u{0:02d}".format(i), age=i % 3) for i in range(20))
+        expected = [u.name for u in User.find(order_by=[User.age, User.name])]
+
+        # walk through all pages with the last row of previous page
+        got = []
+        last = None
+        while True:
+            page = list(User.seek([User.age, User.name], last, limit=6))
+            got.extend(u.name for u in page)
+            if len(page) < 6:
+                break
+            last = page[-1]
+
+        self.assertEqual(got, expected)
+
+        # with condition and descending order
+        page = list(User.seek([User.age.desc(), User.name.desc()], User.find_one(User.name == "u10"),
+                              User.age < 2, limit=3))
+        self.assertEqual([u.name for u in page], ["u07", "u04", "u01"])
+
+        # NULL never matches a comparison, rejected instead of skipping rows
+        User(name="null", age=1).save()
+        last = User.find_one(User.name == "null")
+        self.assertEqual(last.relation, None)
+        with self.assertRaises(Exception):
+            User.seek([User.relation, User.name], last)
+
+    def test_index(self):
+        class Indexed(Model):
+            __toresdo_index__ = [("age", "relation")]
+
+            @field(unique=True)
+            def email(self):
+                return ""
+
+            @field(index=True)
+            def name(self):
+                return ""
+
+            @field()
+            def age(self):
+                return 0
+
+            @field()
+            def relation(self):
+                return 0
+
+        Indexed.save_many(Indexed(email="u{0}@a.com".format(i), name="u{0}".format(i), age=i % 7)
+                          for i in range(100))
+
+        def plan(cond):
+            stmt = Cond.to_cmd(Indexed, cond)
+            idx = Indexed.__conn_pool__.req()
+            try:
+                return " ".join(r[-1] for r in Indexed.__conn_pool__[idx].execute(
+                                "EXPLAIN QUERY PLAN " + stmt[0], stmt[1]))
+            finally:
+                Indexed.__conn_pool__.dispose(idx)
+
+        self.assertIn("USING INDEX ix_Indexed_name", plan(Indexed.name == "u1"))
+        self.assertIn("USING INDEX ux_Indexed_email", plan(Indexed.email == "u1@a.com"))
+        self.assertIn("USING INDEX ix_Indexed_age_relation",
+                      plan(Cond.group(Cond.and__, Indexed.age == 1, Indexed.relation == 0)))
+
+        # unique is enforced
+        with self.assertRaises(sqlite3.IntegrityError):
+            Indexed(email="u1@a.com").save()
+
+    def test_index_unknown_field(self):
+        class BadIndex(Model):
+            __toresdo_index__ = [("nothing",)]
+
+            @field()
+            def name(self):
+                return ""
+
+        with self.assertRaises(Exception):
+            BadIndex()
+
+    def test_save_rows(self):
+        rows = [{"name": "u{0}".format(i), "age": i} for i in range(10)]
+        rows.append(("t0", "t0@a.com", 30, 1, "Taipei"))
+        self.assertEqual(User.save_rows(rows, chunk_size=4), 11)
+
+        u = User.find_one(User.name == "u3")
+        self.assertEqual((u.age, u.email, u.relation), (3, "", None))
+        u = User.find_one(User.name == "t0")
+        self.assertEqual((u.age, u.address), (30, "Taipei"))
+
+        # invalid values are rejected for the whole chunk
+        with self.assertRaises(Exception):
+            User.save_rows([{"name": "bad", "age": "10"}])
+        with self.assertRaises(Exception):
+            User.save_rows([("short", "row")])
+        self.assertEqual(len(list(User.find(User.name == "bad"))), 0)
+
+        # trusted input is never validated
+        self.assertEqual(list(User.isave_rows([{"name": "trusted", "age": "10"}], trusted=True)), [1])
+        self.assertEqual(User.find_one(User.name == "trusted").age, 10)
+
+    def test_listener(self):
+        events = []
+        User.add_listener(events.append)
+        try:
+            User.save_many([User(name="u{0}".format(i), age=i) for i in range(5)])
+            self.assertEqual(len(list(User.find(User.age < 3))), 3)
+            self.assertEqual(User.count(User.age >= 3), 2)
+        finally:
+            User.remove_listener(events.append)
+
+        kinds = [ev.kind for ev in events]
+        for k in ("compile", "acquire", "execute", "fetch", "release", "save"):
+            self.assertIn(k, kinds)
+        self.assertTrue(all(ev.model is User and ev.duration >= 0 for ev in events))
+
+        save = [ev for ev in events if ev.kind == "save"]
+        self.assertEqual(sum(ev.rows for ev in save), 5)
+        fetch = [ev for ev in events if ev.kind == "fetch"]
+        self.assertEqual(sum(ev.rows for ev in fetch), 3)
+        # labeled by SQL, values are never included
+        self.assertEqual(fetch[0].label, "SELECT * FROM User WHERE age<?")
+
+        # nothing is emitted when detached
+        del events[:]
+        list(User.find(User.age < 3))
+        self.assertEqual(events, [])
+
+    def test_listener_on_base(self):
+        agg = StatAggregator()
+        Model.add_listener(agg)
+        try:
+            Account(uid=1, name="a").save()
+            Account.find_one(Account.uid == 1)
+        finally:
+            Model.remove_listener(agg)
+
+        r = agg.report()
+        self.assertEqual(r[("save", "Account", Account._sql_cmd["insert"])]["count"], 1)
+        self.assertIn(("execute", "Account", "SELECT * FROM Account WHERE uid=? LIMIT ?"), r)
+
+    def test_slow_query_log(self):
+        Account.save_many([Account(uid=i, name="a{0}".format(i)) for i in range(5)])
+        # nothing is logged by default
+        list(Account.find(Account.name == "a1"))
+        self.assertEqual(Account.slow_queries(), [])
+
+        with mock.patch.object(Account, "__toresdo_slow_query__", 0), \
+             mock.patch.object(Account, "__toresdo_slow_query_log_size__", 2):
+            list(Account.find(Account.name == "a1"))
+            Account.find_one(Account.uid == 1)
+            Account.count(Account.uid > 2)
+
+            log = Account.slow_queries()
+            # the oldest one is dropped
+            self.assertEqual([q.sql for q in log],
+                             ["SELECT * FROM Account WHERE uid=? LIMIT ?",
+                              "SELECT COUNT(*) FROM Account WHERE uid>?"])
+            self.assertEqual(log[0].params, (1, 1))
+            self.assertTrue(all(q.duration >= 0 and q.plan for q in log))
+            # searched by primary-key
+            self.assertEqual(log[0].scans, [])
+
+            # full table scan is flagged
+            Account.exists(Account.name == "nobody")
+            q = Account.slow_queries(clear=True)[-1]
+            self.assertEqual(q.scans, ["Account"])
+            self.assertEqual(Account.slow_queries(), [])
+
+            # inserts are never logged
+            Account(uid=10, name="b").save()
+            self.assertEqual(Account.slow_queries(), [])
+
+    def test_slow_query_fetching(self):
+        Account.save_many([Account(uid=i, name="a{0}".format(i)) for i in range(3)])
+
+        class Clock(object):
+            # each reading is one second later
+            now = 0.0
+
+            def perf_counter(self):
+                Clock.now += 1.0
+                return Clock.now
+
+            def time(self):
+                return time.time()
+
+        with mock.patch.object(Account, "__toresdo_slow_query__", 2.5), \
+             mock.patch("toresdo.dal.sql.sqlite.time", Clock()):
+            # executing takes 1s, and each of 4 batches takes 1s more
+            s = Account.find(Account.name != "", batch_size=1)
+            next(s)
+            self.assertEqual(Account.slow_queries(), [])
+            self.assertEqual(len(list(s)), 2)
+
+            log = Account.slow_queries(clear=True)
+            self.assertEqual([q.sql for q in log], ["SELECT * FROM Account WHERE name<>?"])
+            self.assertEqual(log[0].duration, 5.0)
+            self.assertEqual(log[0].scans, ["Account"])
+
+            # fast ones are not logged
+            Account.find_one(Account.uid == 1)
+            self.assertEqual(Account.slow_queries(), [])
+
+    def test_slow_query_scans(self):
+        from toresdo.dal.sql.sqlite import SlowQuery
+
+        self.assertEqual(SlowQuery._scans(["SCAN User"]), ["User"])
+        self.assertEqual(SlowQuery._scans(["SCAN TABLE User"]), ["User"])
+        self.assertEqual(SlowQuery._scans(["SCAN User USING INDEX ix_User_age",
+                                           "SEARCH User USING INTEGER PRIMARY KEY (rowid=?)",
+                                           "SCAN json_each VIRTUAL TABLE INDEX 1:",
+                                           "SCAN CONSTANT ROW"]), [])
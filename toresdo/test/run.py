@@ -10,7 +10,9 @@ import unittest
 TEST_MODULES = [
     'toresdo.test.dal.basic',
     'toresdo.test.dal.mongo.motor',
-    'toresdo.test.dal.sql.sqlite'
+    'toresdo.test.dal.mongo.motor_fake',
+    'toresdo.test.dal.sql.sqlite',
+    'toresdo.test.bench'
 ]
 
 